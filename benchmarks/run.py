@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of ZipStream and AioZipStream
+
+Fixtures are generated in temporary directory, and each case is executed
+in separate process, to measure its peak memory usage. Results are saved
+as JSON, so they can be compared between runs.
+
+    ./benchmarks/run.py --output before.json
+    ./benchmarks/run.py --output after.json --filter deflate
+    ./benchmarks/run.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from zipstream import ZipStream, AioZipStream  # noqa: E402
+
+
+# archive shapes: number of files and size of each file
+SHAPES = {"tiny": (2000, 1024),
+          "huge": (2, 32 * 1024 * 1024)}
+DATA = ("text", "random")
+COMPRESSION = (None, "deflate")
+CHUNKSIZES = (1024, 16 * 1024, 256 * 1024)
+CONCURRENCY = (1, 4, 16)
+
+
+def make_data(kind, size, rnd):
+    if kind == "random":
+        return os.urandom(size)
+    words = [b"%x" % rnd.getrandbits(24) for n in range(1000)]
+    data = bytearray()
+    while len(data) < size:
+        data += b" ".join(rnd.choice(words) for n in range(100)) + b"\n"
+    return bytes(data[:size])
+
+
+def make_fixtures(directory, scale):
+    """
+    create files for all shapes and kinds of data
+    """
+    rnd = random.Random(1234)
+    for shape, (count, size) in SHAPES.items():
+        if shape == "tiny":
+            count = max(int(count * scale), 1)
+        else:
+            size = max(int(size * scale), 1)
+        for kind in DATA:
+            path = os.path.join(directory, "%s-%s" % (shape, kind))
+            os.mkdir(path)
+            # tiny files share the same content, it does not matter here
+            data = make_data(kind, size, rnd)
+            for n in range(count):
+                with open(os.path.join(path, "%05d.dat" % n), "wb") as fo:
+                    fo.write(data)
+
+
+def all_cases():
+    for shape in SHAPES:
+        for kind in DATA:
+            for compression in COMPRESSION:
+                for chunksize in CHUNKSIZES:
+                    yield {"shape": shape, "data": kind,
+                           "compression": compression, "chunksize": chunksize,
+                           "mode": "sync", "concurrency": 1}
+    for shape in SHAPES:
+        for mode in ("sync", "aio"):
+            for concurrency in CONCURRENCY:
+                yield {"shape": shape, "data": "text", "compression": "deflate",
+                       "chunksize": 64 * 1024, "mode": mode,
+                       "concurrency": concurrency}
+
+
+def case_name(case):
+    return "%(mode)s-c%(concurrency)d-%(shape)s-%(data)s-%(compression)s-%(chunksize)d" % case
+
+
+def files_of_case(case, fixtures):
+    path = os.path.join(fixtures, "%s-%s" % (case["shape"], case["data"]))
+    return [{"file": os.path.join(path, name), "compression": case["compression"]}
+            for name in sorted(os.listdir(path))]
+
+
+class Sink:
+    """
+    consumer of archive, which counts bytes and writes
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.ttfb = None
+        self.size = self.writes = 0
+
+    def write(self, chunk):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+        self.size += len(chunk)
+        self.writes += 1
+
+
+def run_sync(case, files, start):
+    sink = Sink(start)
+    for chunk in ZipStream(files, chunksize=case["chunksize"]).stream():
+        sink.write(chunk)
+    return sink
+
+
+async def run_aio(case, files, start):
+    sink = Sink(start)
+    zs = AioZipStream(files, chunksize=case["chunksize"])
+    async for chunk in zs.stream():
+        sink.write(chunk)
+    return sink
+
+
+def run_case(case, fixtures):
+    """
+    execute single case and return its results
+    """
+    files = files_of_case(case, fixtures)
+    src_size = sum(os.path.getsize(f["file"]) for f in files)
+    start = time.perf_counter()
+    if case["mode"] == "aio":
+        async def run_all():
+            return await asyncio.gather(*[run_aio(case, files, start)
+                                          for n in range(case["concurrency"])])
+        sinks = asyncio.run(run_all())
+    else:
+        sinks = [None] * case["concurrency"]
+
+        def run(idx):
+            sinks[idx] = run_sync(case, files, start)
+        threads = [threading.Thread(target=run, args=(n, ))
+                   for n in range(case["concurrency"])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - start
+    total = src_size * case["concurrency"]
+    writes = sum(s.writes for s in sinks)
+    return {"name": case_name(case),
+            "case": case,
+            "seconds": elapsed,
+            "source_bytes": total,
+            "archive_bytes": sinks[0].size,
+            "mb_per_s": total / elapsed / 1e6,
+            "ttfb_ms": max(s.ttfb for s in sinks) * 1000,
+            "writes": writes,
+            "writes_per_s": writes / elapsed,
+            # kB on linux, bytes on macos
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_all(args):
+    fixtures = tempfile.mkdtemp(prefix="zipstream_bench_")
+    try:
+        make_fixtures(fixtures, args.scale)
+        results = []
+        for case in all_cases():
+            name = case_name(case)
+            if args.filter and not fnmatch.fnmatch(name, "*%s*" % args.filter):
+                continue
+            proc = subprocess.run(
+                [sys.executable, __file__, "--run-case", json.dumps(case),
+                 "--fixtures", fixtures],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode:
+                result = {"name": name, "case": case,
+                          "error": proc.stderr.decode().strip().splitlines()[-1]}
+                print("%-45s error: %s" % (name, result["error"]))
+            else:
+                result = json.loads(proc.stdout.decode())
+                print("%-45s %9.1f MB/s  ttfb %8.2f ms  %10.0f writes/s  rss %7d kB" % (
+                    name, result["mb_per_s"], result["ttfb_ms"],
+                    result["writes_per_s"], result["peak_rss_kb"]))
+            results.append(result)
+    finally:
+        shutil.rmtree(fixtures)
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": os.cpu_count(),
+              "scale": args.scale,
+              "results": results}
+    with open(args.output, "w") as fo:
+        json.dump(report, fo, indent=2)
+    print("results saved in %s" % args.output)
+
+
+def compare(old_path, new_path):
+    with open(old_path) as fo:
+        old = {r["name"]: r for r in json.load(fo)["results"]}
+    with open(new_path) as fo:
+        new = json.load(fo)["results"]
+    print("%-45s %10s %10s %8s" % ("case", "old MB/s", "new MB/s", "change"))
+    for result in new:
+        prev = old.get(result["name"])
+        if prev is None or "error" in prev or "error" in result:
+            continue
+        change = result["mb_per_s"] / prev["mb_per_s"] - 1
+        print("%-45s %10.1f %10.1f %+7.1f%%" % (
+            result["name"], prev["mb_per_s"], result["mb_per_s"], change * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="bench_results.json",
+                        help="file where results are saved")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale of fixtures size")
+    parser.add_argument("--filter", help="run only cases with this in name")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare results of two runs")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--fixtures", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    elif args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.fixtures)))
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
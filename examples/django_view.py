@@ -16,4 +16,6 @@ def stream_as_zip(request):
         stream.stream(),
         content_type="application/zip")
     response['Content-Disposition'] = 'attachment; filename="%s"' % streamed_data_filename
+    # all files are not compressed, so size of archive is known in advance
+    response['Content-Length'] = stream.total_size()
     return response
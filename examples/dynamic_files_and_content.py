@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
-import os
 import random
-from zipstream import ZipStream
+from zipstream import ZipStream, walk_files
 
 
 def bin_generator(lines):
@@ -15,11 +14,8 @@ def bin_generator(lines):
 
 
 def files_to_stream(dirname):
-    for f in os.listdir(dirname):
-        fp = os.path.join(dirname, f)
-        if os.path.isfile(fp):
-            name = "foo_" + os.path.basename(fp)
-            yield {'file': fp, 'name': name}
+    for source in walk_files(dirname, prefix="foo/", directories=False):
+        yield source
     yield {'stream': bin_generator(10), 'name': 'foo.txt'}
 
 
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 from __future__ import unicode_literals, absolute_import
-from unittest import TestCase, main, skip
+from unittest import TestCase, main, skip, mock
+import io
 import os
+import time
 import zipfile
 import zipstream
 import zlib, struct
@@ -23,10 +25,10 @@ class FileUsingTestBase(object):
             length = random.randint(10,50)
         temptxt = b"This is temporary file.\n"
         idx,pos = 0,0
-        with open(tf, "w") as f:
+        with open(tf, "wb") as f:
             while idx<length:
                 idx+=1
-                f.write( temptxt[pos] )
+                f.write( temptxt[pos:pos+1] )
                 pos+=1
                 if pos>=len(temptxt):
                     pos = 0
@@ -113,6 +115,844 @@ class ZipStreamTestCase(FileUsingTestBase, TestCase):
 
         cdentry = res[ cdpos: cdpos+cdsize ]
 
+    def test_zip64_structs(self):
+        self.assertEqual( zipfile.sizeEndCentDir64, zipstream.consts.CD_END64_STRUCT.size )
+        self.assertEqual( zipfile.sizeEndCentDir64Locator, zipstream.consts.CD_LOC64_STRUCT.size )
+        self.assertEqual( zipstream.consts.CD_END64_MAGIC, zipfile.stringEndArchive64 )
+        self.assertEqual( zipstream.consts.CD_LOC64_MAGIC, zipfile.stringEndArchive64Locator )
+
+    def test_zip64_forced(self):
+        tf = self._add_temp_file(100)
+        zs = zipstream.ZipStream([
+            {"file": tf, "name": "a.txt"},
+            {"stream": [b"foo ", b"bar"], "name": "b.txt",
+             "compression": "deflate", "zip64": True},
+        ])
+        zs.zip64_required()
+        res = b"".join(zs.stream())
+        # zip64 end record and locator are placed before end record
+        self.assertEqual( res[-98:-94], zipstream.consts.CD_END64_MAGIC )
+        self.assertEqual( res[-42:-38], zipstream.consts.CD_LOC64_MAGIC )
+        # 64 bit data descriptor
+        pos = res.find( zipstream.consts.LF_MAGIC, 10 )
+        self.assertEqual( res[pos-24:pos-20], zipstream.consts.DD_MAGIC )
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            self.assertEqual( zf.read("b.txt"), b"foo bar" )
+            self.assertEqual( zf.read("a.txt"), open(tf, "rb").read() )
+
+    def test_zip64_automatic(self):
+        # lower the limit so all structures cross it
+        limit = zipstream.consts.ZIP32_LIMIT
+        zipstream.consts.ZIP32_LIMIT = 10
+        try:
+            zs = zipstream.ZipStream([
+                {"stream": [b"0123456789" * 3], "name": "a.txt"},
+                {"stream": [b"abc"], "name": "b.txt", "compression": "deflate"},
+            ])
+            res = b"".join(zs.stream())
+        finally:
+            zipstream.consts.ZIP32_LIMIT = limit
+        self.assertEqual( res[-98:-94], zipstream.consts.CD_END64_MAGIC )
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            self.assertEqual( zf.read("a.txt"), b"0123456789" * 3 )
+            self.assertEqual( zf.read("b.txt"), b"abc" )
+
+    def test_parallel_workers(self):
+        def files():
+            for n in range(10):
+                yield {"stream": [b"line %d\n" % m for m in range(n * 500)],
+                       "name": "f%d.txt" % n, "compression": "deflate"}
+            yield {"file": self._add_temp_file(300), "name": "stored.txt"}
+        # all entries need the same timestamp
+        with mock.patch("time.localtime", return_value=time.localtime()):
+            serial = b"".join(zipstream.ZipStream(files()).stream())
+            zs = zipstream.ZipStream(files(), workers=4, buffer_limit=4096)
+            parallel = b"".join(zs.stream())
+        self.assertEqual( serial, parallel )
+        with zipfile.ZipFile(io.BytesIO(parallel)) as zf:
+            self.assertIsNone( zf.testzip() )
+
+    def test_parallel_workers_error(self):
+        def broken():
+            yield b"foo"
+            raise ValueError("broken source")
+        zs = zipstream.ZipStream([{"stream": [b"ok"], "name": "a"},
+                                  {"stream": broken(), "name": "b"}],
+                                 workers=2)
+        with self.assertRaises(ValueError):
+            b"".join(zs.stream())
+
+    def test_crc32_combine(self):
+        a, b = b"foo baz bar" * 7, b"something else" * 13
+        crc = zipstream.zipstream.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b))
+        self.assertEqual( crc, zlib.crc32(a + b) & 0xffffffff )
+
+    def test_block_workers(self):
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        zs = zipstream.ZipStream(
+            [{"stream": [data[i:i+3000] for i in range(0, len(data), 3000)],
+              "name": "big.txt", "compression": "deflate"},
+             {"stream": [], "name": "empty.txt", "compression": "deflate"}],
+            block_workers=3, block_size=4096)
+        res = b"".join(zs.stream())
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            self.assertEqual( zf.read("big.txt"), data )
+            self.assertEqual( zf.read("empty.txt"), b"" )
+        # threads are stopped when streaming is interrupted
+        import threading
+        threads = threading.active_count()
+        parts = zipstream.ZipStream(
+            [{"stream": [data], "name": "big.txt", "compression": "deflate"}],
+            block_workers=3, block_size=4096).stream()
+        next(parts)
+        next(parts)
+        parts.close()
+        self.assertEqual( threading.active_count(), threads )
+        # with entries processed by workers, single executor is created
+        files = [{"stream": [data], "name": "%d.txt" % n, "compression": "deflate"}
+                 for n in range(6)]
+        from concurrent import futures
+        with mock.patch("concurrent.futures.ThreadPoolExecutor",
+                        wraps=futures.ThreadPoolExecutor) as executors:
+            zs = zipstream.ZipStream(files, workers=3, block_workers=2, block_size=4096)
+            res = b"".join(zs.stream())
+            parts = zipstream.ZipStream(files, workers=3, block_workers=2,
+                                        block_size=4096).stream()
+            next(parts)
+            parts.close()
+        self.assertEqual( [c[1]["max_workers"] for c in executors.call_args_list],
+                          [2, 3] * 2 )
+        self.assertEqual( threading.active_count(), threads )
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertEqual( zf.read("5.txt"), data )
+
+    def test_aio_block_workers(self):
+        import asyncio
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        async def source():
+            for i in range(0, len(data), 3000):
+                yield data[i:i+3000]
+        async def run():
+            zs = zipstream.AioZipStream(
+                [{"stream": source(), "name": "big.txt", "compression": "deflate"}],
+                block_workers=2, block_size=4096)
+            return b"".join([chunk async for chunk in zs.stream()])
+        res = asyncio.run(run())
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertEqual( zf.read("big.txt"), data )
+
+    def test_total_size(self):
+        files = [{"file": self._add_temp_file(), "name": "a.txt"},
+                 {"file": self._add_temp_file(500), "name": "b.txt"},
+                 {"file": self._add_temp_file(0), "name": "żółw.txt"}]
+        zs = zipstream.ZipStream(files)
+        size = zs.total_size()
+        self.assertEqual( size, len(b"".join(zs.stream())) )
+        zs.zip64_required()
+        self.assertEqual( zs.total_size(), len(b"".join(zs.stream())) )
+
+    def test_total_size_unknown(self):
+        zs = zipstream.ZipStream([{"stream": [b"abc"], "name": "a.txt"}])
+        with self.assertRaises(Exception):
+            zs.total_size()
+        # 'auto' streams are not read, also asynchronous ones
+        async def source():
+            yield b"abc"
+        stream = iter([b"abc"])
+        for zs in (zipstream.ZipStream([{"stream": stream, "name": "a.txt",
+                                         "compression": "auto"}]),
+                   zipstream.AioZipStream([{"stream": source(), "name": "a.txt",
+                                            "compression": "auto"}])):
+            with self.assertRaisesRegex(Exception, "Size of 'a.txt' entry is unknown"):
+                zs.total_size()
+        self.assertEqual( list(stream), [b"abc"] )
+
+    def test_stream_range(self):
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        files = [{"file": self._add_temp_file(), "name": "a.txt"},
+                 {"directory": directory, "name": "d"},
+                 {"file": self._add_temp_file(500), "name": "b.txt"},
+                 {"file": self._add_temp_file(0), "name": "empty.txt"},
+                 {"file": self._add_temp_file(30), "name": "c.txt"}]
+        crc_cache = {}
+        zs = zipstream.ZipStream(files, crc_cache=crc_cache)
+        res = b"".join(zs.stream())
+        self.assertEqual( len(crc_cache), 4 )
+        # crc is calculated when not in cache
+        for cache in (crc_cache, None):
+            zs = zipstream.ZipStream(files, chunksize=7, crc_cache=cache)
+            self.assertEqual( b"".join(zs.stream_range(0)), res )
+            for start, end in ((0, 10), (5, 100), (40, 600), (300, len(res) - 5),
+                               (len(res) - 30, len(res) + 100), (len(res), None)):
+                self.assertEqual( b"".join(zs.stream_range(start, end)), res[start:end] )
+
+    def test_stream_to(self):
+        import socket, tempfile
+        files = [{"file": self._add_temp_file(), "name": "a.txt"},
+                 {"stream": [b"foo", b"bar"], "name": "b.txt",
+                  "compression": "deflate"},
+                 {"file": self._add_temp_file(500), "name": "c.txt"}]
+        # streams have current time
+        now = mock.patch("time.time", return_value=1600000000.0)
+        now.start()
+        self.addCleanup(now.stop)
+        res = b"".join(zipstream.ZipStream(files).stream())
+        # file descriptor
+        with tempfile.TemporaryFile() as fo:
+            files[1]["stream"] = [b"foo", b"bar"]
+            zs = zipstream.ZipStream(files, workers=2)
+            self.assertEqual( zs.stream_to(fo), len(res) )
+            fo.seek(0)
+            self.assertEqual( fo.read(), res )
+        # socket
+        files[1]["stream"] = [b"foo", b"bar"]
+        a, b = socket.socketpair()
+        with a, b:
+            self.assertEqual( zipstream.ZipStream(files).stream_to(a), len(res) )
+            a.shutdown(socket.SHUT_WR)
+            received = b""
+            while len(received) < len(res):
+                received += b.recv(65536)
+        self.assertEqual( received, res )
+
+    def test_aio_stream_to(self):
+        import asyncio, socket
+        files = [{"file": self._add_temp_file(), "name": "a.txt"},
+                 {"file": self._add_temp_file(500), "name": "c.txt"}]
+        res = b"".join(zipstream.ZipStream(files).stream())
+        async def run(a, b):
+            loop = asyncio.get_running_loop()
+            zs = zipstream.AioZipStream(files)
+            self.assertEqual( await zs.stream_to(a), len(res) )
+            received = b""
+            while len(received) < len(res):
+                received += await loop.sock_recv(b, 65536)
+            return received
+        a, b = socket.socketpair()
+        with a, b:
+            a.setblocking(False)
+            b.setblocking(False)
+            self.assertEqual( asyncio.run(run(a, b)), res )
+
+    def test_aio_write_to(self):
+        import asyncio
+        files = [{"file": self._add_temp_file(n), "name": "%d.txt" % n}
+                 for n in (100, 3000, 40000)]
+        res = b"".join(zipstream.ZipStream(files).stream())
+        class Writer:
+            def __init__(self):
+                self.data = []
+                self.drains = 0
+            def writelines(self, chunks):
+                self.data.extend(chunks)
+            async def drain(self):
+                self.drains += 1
+        writer = Writer()
+        zs = zipstream.AioZipStream(files)
+        self.assertEqual( asyncio.run(zs.write_to(writer, high_water=16384)), len(res) )
+        self.assertEqual( b"".join(writer.data), res )
+        self.assertLess( writer.drains, len(res) // 16384 + 2 )
+        self.assertLess( writer.drains, len(writer.data) )
+
+    def test_write_size(self):
+        def files():
+            return [{"file": self._add_temp_file(40), "name": "%d.txt" % n}
+                    for n in range(20)]
+        files = files()
+        res = b"".join(zipstream.ZipStream(files).stream())
+        chunks = list(zipstream.ZipStream(files, write_size=256).stream())
+        self.assertEqual( b"".join(chunks), res )
+        self.assertTrue( all(len(c) == 256 for c in chunks[:-1]) )
+        # everything is flushed at once
+        chunks = list(zipstream.ZipStream(files, write_size=256,
+                                          flush_interval=0).stream())
+        self.assertEqual( b"".join(chunks), res )
+        self.assertTrue( any(len(c) < 256 for c in chunks[:-1]) )
+
+    def test_aio_offload(self):
+        import asyncio
+        from concurrent import futures
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        async def source(step):
+            for i in range(0, len(data), step):
+                yield data[i:i+step]
+        async def run(executor):
+            zs = zipstream.AioZipStream(
+                [{"stream": source(100), "name": "a.txt", "compression": "deflate"},
+                 {"stream": source(5000), "name": "b.txt", "compression": "deflate"},
+                 {"stream": source(700), "name": "c.txt"}],
+                executor=executor, offload_size=4096)
+            return b"".join([chunk async for chunk in zs.stream()])
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            res = asyncio.run(run(executor))
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            for name in ("a.txt", "b.txt", "c.txt"):
+                self.assertEqual( zf.read(name), data )
+
+    def test_entry_cache(self):
+        import tempfile, shutil
+        cachedir = tempfile.mkdtemp(prefix="_zipstream_cache_")
+        self.addCleanup(shutil.rmtree, cachedir)
+        cache = zipstream.EntryCache(cachedir)
+        files = [{"file": self._add_temp_file(300), "name": "a.txt",
+                  "compression": "deflate"},
+                 {"file": self._add_temp_file(500), "name": "b.txt",
+                  "compression": "deflate"},
+                 {"file": self._add_temp_file(50), "name": "c.txt"}]
+        res = b"".join(zipstream.ZipStream(files).stream())
+        self.assertEqual( b"".join(zipstream.ZipStream(files, cache=cache).stream()), res )
+        self.assertEqual( cache.stats()["misses"], 2 )
+        self.assertEqual( cache.stats()["hits"], 0 )
+        for zs in (zipstream.ZipStream(files, cache=cache),
+                   zipstream.ZipStream(files, cache=cache, workers=2)):
+            self.assertEqual( b"".join(zs.stream()), res )
+        self.assertEqual( cache.stats()["hits"], 4 )
+        with tempfile.TemporaryFile() as fo:
+            zipstream.ZipStream(files, cache=cache).stream_to(fo)
+            fo.seek(0)
+            self.assertEqual( fo.read(), res )
+        # oldest entry is removed
+        small = zipstream.EntryCache(cachedir, max_size=cache.size - 1)
+        self.assertEqual( small.size, cache.size )
+        new = [{"file": self._add_temp_file(100), "compression": "deflate"}]
+        b"".join(zipstream.ZipStream(new, cache=small).stream())
+        self.assertEqual( small.stats()["evictions"], 1 )
+        self.assertLessEqual( small.size, small.max_size )
+        # entries removed from cache after they were found are still streamed
+        for workers in (0, 2):
+            shared = zipstream.EntryCache(tempfile.mkdtemp(dir=cachedir))
+            b"".join(zipstream.ZipStream(files, cache=shared).stream())
+            parts = zipstream.ZipStream(files, cache=shared, workers=workers).stream()
+            head = next(parts)
+            for name in os.listdir(shared.directory):
+                os.unlink(os.path.join(shared.directory, name))
+            self.assertEqual( head + b"".join(parts), res )
+            self.assertEqual( shared.stats()["hits"], 1 + workers // 2 )
+
+    def test_auto_compression(self):
+        import asyncio
+        text = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        noise = os.urandom(100000)
+        def files(stream):
+            return [{"stream": stream(text), "name": "a.txt", "compression": "auto"},
+                    {"stream": stream(noise), "name": "b.bin", "compression": "auto"},
+                    {"stream": stream(text), "name": "c.jpg", "compression": "auto"},
+                    {"stream": stream(b"\x1f\x8b" + text), "name": "d", "compression": "auto"},
+                    {"file": self._add_temp_file(1000), "compression": "auto"}]
+        def sync_stream(data):
+            for i in range(0, len(data), 1000):
+                yield data[i:i+1000]
+        async def aio_stream(data):
+            for chunk in sync_stream(data):
+                yield chunk
+        async def run():
+            zs = zipstream.AioZipStream(files(aio_stream))
+            return b"".join([chunk async for chunk in zs.stream()])
+        for res in (b"".join(zipstream.ZipStream(files(sync_stream)).stream()),
+                    asyncio.run(run())):
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                methods = [i.compress_type for i in zf.infolist()]
+                self.assertEqual( methods, [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED,
+                                            zipfile.ZIP_STORED, zipfile.ZIP_STORED,
+                                            zipfile.ZIP_DEFLATED] )
+                self.assertEqual( zf.read("a.txt"), text )
+                self.assertEqual( zf.read("b.bin"), noise )
+
+    def test_compression_methods(self):
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        def files():
+            return [{"stream": [data], "name": "a.txt", "compression": "bzip2"},
+                    {"stream": [data[:5000], data[5000:]], "name": "b.txt",
+                     "compression": "lzma"},
+                    {"stream": [data], "name": "c.txt", "compression": "deflate",
+                     "compression_level": 9},
+                    {"stream": [data], "name": "d.txt", "compression": "deflate"}]
+        res = b"".join(zipstream.ZipStream(files(), compression_level=1).stream())
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            infos = zf.infolist()
+            self.assertEqual( [i.compress_type for i in infos],
+                              [zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA,
+                               zipfile.ZIP_DEFLATED, zipfile.ZIP_DEFLATED] )
+            self.assertEqual( infos[0].extract_version, 46 )
+            self.assertEqual( infos[1].extract_version, 63 )
+            # level 9 and level 1 from default
+            self.assertLess( infos[2].compress_size, infos[3].compress_size )
+            for info in infos:
+                self.assertEqual( zf.read(info), data )
+
+    def test_compression_level_wrong(self):
+        zs = zipstream.ZipStream([{"stream": [b"abc"], "name": "a.txt",
+                                   "compression": "bzip2", "compression_level": 0}])
+        with self.assertRaises(Exception):
+            b"".join(zs.stream())
+
+    def test_compression_level_default(self):
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        files = [{"stream": [data], "name": "a.txt"},
+                 {"stream": [data], "name": "b.txt", "compression": "deflate"},
+                 {"stream": [os.urandom(1000)], "name": "c.bin", "compression": "auto"},
+                 {"stream": [data], "name": "d.txt", "compression": "bzip2"}]
+        for level in (0, 1, 12):
+            res = b"".join(zipstream.ZipStream([dict(f) for f in files],
+                                               compression_level=level).stream())
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                self.assertEqual( [i.compress_type for i in zf.infolist()],
+                                  [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED,
+                                   zipfile.ZIP_STORED, zipfile.ZIP_BZIP2] )
+                self.assertEqual( zf.read("b.txt"), data )
+        # level of entry with 'auto' compression, which chooses store
+        import asyncio
+        noise = os.urandom(5000)
+        def auto_files(stream):
+            return [{"stream": stream([noise]), "name": "a.bin", "compression": "auto",
+                     "compression_level": 9},
+                    {"stream": stream([data]), "name": "b.txt", "compression": "auto",
+                     "compression_level": 9},
+                    {"stream": stream([data]), "name": "c.jpg", "compression": "auto",
+                     "compression_level": 9}]
+        async def aio_stream(chunks):
+            for chunk in chunks:
+                yield chunk
+        async def run():
+            zs = zipstream.AioZipStream(auto_files(aio_stream))
+            return b"".join([chunk async for chunk in zs.stream()])
+        for res in (b"".join(zipstream.ZipStream(auto_files(iter)).stream()),
+                    asyncio.run(run())):
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                self.assertEqual( [i.compress_type for i in zf.infolist()],
+                                  [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED,
+                                   zipfile.ZIP_STORED] )
+        # level 0 of deflate stores data in blocks
+        res = b"".join(zipstream.ZipStream(files[1:2], compression_level=0).stream())
+        self.assertGreater( len(res), len(data) )
+
+    def test_observer(self):
+        import asyncio
+        data = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        class Recorder(zipstream.Observer):
+            def __init__(self):
+                self.events = []
+            def archive_start(self, archive):
+                self.events.append("start")
+            def first_byte(self, archive):
+                self.events.append("first")
+            def entry_start(self, entry):
+                self.events.append("entry_start:%s" % entry.name)
+            def entry_end(self, entry):
+                self.events.append("entry_end:%s" % entry.name)
+                self.last = entry
+            def archive_end(self, archive):
+                self.events.append("end")
+                self.archive = archive
+        def files(stream):
+            return [{"stream": stream([b"abc"]), "name": "a.txt"},
+                    {"stream": stream([data[:20000], data[20000:]]), "name": "b.txt",
+                     "compression": "deflate"}]
+        async def aio_stream(chunks):
+            for chunk in chunks:
+                yield chunk
+        async def run(observer):
+            zs = zipstream.AioZipStream(files(aio_stream), observer=observer)
+            return b"".join([chunk async for chunk in zs.stream()])
+        for mode in ("sync", "aio"):
+            observer = Recorder()
+            if mode == "sync":
+                res = b"".join(zipstream.ZipStream(files(iter), observer=observer).stream())
+            else:
+                res = asyncio.run(run(observer))
+            self.assertEqual( observer.events, ["start", "entry_start:a.txt", "first",
+                                                "entry_end:a.txt", "entry_start:b.txt",
+                                                "entry_end:b.txt", "end"] )
+            entry = observer.last
+            self.assertEqual( entry.in_bytes, len(data) )
+            self.assertEqual( entry.crc, zlib.crc32(data) & 0xffffffff )
+            self.assertLess( entry.out_bytes, entry.in_bytes )
+            self.assertGreater( entry.compress_time, 0 )
+            self.assertEqual( observer.archive.entries, 2 )
+            self.assertEqual( observer.archive.total_bytes, len(res) )
+            self.assertEqual( observer.archive.cdir_size, 2 * 46 + len("a.txtb.txt") )
+
+    def test_many_entries(self):
+        zs = zipstream.ZipStream(
+            {"stream": [b"%d" % n], "name": "d/%05d.txt" % n} for n in range(3000))
+        res = b"".join(zs.stream())
+        with zipfile.ZipFile(io.BytesIO(res)) as zf:
+            self.assertIsNone( zf.testzip() )
+            names = zf.namelist()
+            self.assertEqual( len(names), 3000 )
+            self.assertEqual( zf.read(names[-1]), b"2999" )
+        # entries are not kept, only packed central directory
+        self.assertFalse( hasattr(zipstream.zipstream._FileStruct(False), '__dict__') )
+        self.assertEqual( zipstream.zipstream._dos_datetime(0x50000000),
+                          zs._dos_datetime(0x50000000 + 0.5) )
+
+    def test_read_ahead(self):
+        files = [self._add_temp_file(n) for n in (5000, 0, 70000, 300)]
+        sources = [{"file": tf, "compression": cmpr}
+                   for tf in files for cmpr in (None, "deflate")]
+        expected = b"".join(zipstream.ZipStream(sources, chunksize=4096).stream())
+        zs = zipstream.ZipStream(sources, chunksize=4096, read_ahead=3)
+        res = b"".join(zs.stream())
+        self.assertEqual( res, expected )
+        # file which can't be read
+        zs = zipstream.ZipStream([{"file": files[0]}], read_ahead=2)
+        with mock.patch("zipstream.zipstream.open", side_effect=IOError("gone"),
+                        create=True):
+            self.assertRaises( IOError, b"".join, zs.stream() )
+
+    def test_mmap(self):
+        files = [self._add_temp_file(n) for n in (0, 10, 70000)]
+        sources = [{"file": tf, "compression": cmpr}
+                   for tf in files for cmpr in (None, "deflate")]
+        expected = b"".join(zipstream.ZipStream(sources, chunksize=4096).stream())
+        zs = zipstream.ZipStream(sources, chunksize=4096, mmap_threshold=0)
+        self.assertEqual( b"".join(zs.stream()), expected )
+        # file changes during streaming
+        tf = self._add_temp_file(10000)
+        data = open(tf, "rb").read()
+        zs = zipstream.ZipStream(chunksize=4096, mmap_threshold=0)
+        chunks = zs.data_generator(tf, 'f')
+        self.assertIsInstance( next(chunks), memoryview )
+        with open(tf, "ab") as fo:
+            fo.write(b"grown")
+        self.assertEqual( b"".join(chunks), data[4096:] + b"grown" )
+        # size is checked for each chunk
+        with mock.patch("zipstream.zipstream.MMAP_CHECK_SIZE", 0):
+            chunks = zs.data_generator(tf, 'f')
+            next(chunks)
+            with open(tf, "r+b") as fo:
+                fo.truncate(6000)
+            self.assertEqual( b"".join(chunks), data[4096:6000] )
+        # and once per MMAP_CHECK_SIZE by default
+        with mock.patch("os.fstat", wraps=os.fstat) as fstat:
+            zs = zipstream.ZipStream(chunksize=1024, mmap_threshold=0)
+            self.assertEqual( b"".join(zs.data_generator(files[2], 'f')),
+                              open(files[2], "rb").read() )
+            self.assertLess( fstat.call_count, 5 )
+
+    def test_aio_read_ahead(self):
+        import asyncio
+        files = [self._add_temp_file(n) for n in (0, 5000, 70000)]
+        sources = [{"file": tf, "compression": cmpr}
+                   for tf in files for cmpr in (None, "deflate")]
+        expected = b"".join(zipstream.ZipStream(sources).stream())
+        async def run(**kwargs):
+            zs = zipstream.AioZipStream(sources, offload_size=4096, **kwargs)
+            return b"".join([chunk async for chunk in zs.stream()])
+        self.assertEqual( asyncio.run(run(read_ahead=4)), expected )
+        self.assertEqual( asyncio.run(run()), expected )
+        async def interrupted():
+            zs = zipstream.AioZipStream(sources[4:], offload_size=4096, read_ahead=4)
+            chunks = zs.data_generator(files[2], 'f')
+            chunk = await chunks.__anext__()
+            await chunks.aclose()
+            return chunk
+        self.assertEqual( asyncio.run(interrupted()), open(files[2], "rb").read()[:4096] )
+
+    def test_append_to(self):
+        import tempfile
+        tf = self._add_temp_file(3000)
+        def new_files():
+            return [{"file": tf, "name": "new/a.txt"},
+                    {"stream": [b"foo ", b"bar"], "name": "new/b.txt",
+                     "compression": "deflate"}]
+        fd, path = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+        try:
+            for zip64 in (False, True):
+                zs = zipstream.ZipStream([{"stream": [b"old"], "name": "old.txt"}])
+                if zip64:
+                    zs.zip64_required()
+                with open(path, "wb") as fo:
+                    fo.write(b"".join(zs.stream()))
+                zipstream.ZipStream(new_files()).append_to(path)
+                with zipfile.ZipFile(path) as zf:
+                    self.assertIsNone( zf.testzip() )
+                    self.assertEqual( zf.namelist(), ["old.txt", "new/a.txt", "new/b.txt"] )
+                    self.assertEqual( zf.read("old.txt"), b"old" )
+                    self.assertEqual( zf.read("new/b.txt"), b"foo bar" )
+            # archive created by zipfile, with comment
+            with zipfile.ZipFile(path, "w") as zf:
+                zf.writestr("old.txt", b"old" * 100, zipfile.ZIP_DEFLATED)
+                zf.comment = b"comment"
+            zipstream.ZipStream(new_files()).append_to(path)
+            with zipfile.ZipFile(path) as zf:
+                self.assertIsNone( zf.testzip() )
+                self.assertEqual( len(zf.namelist()), 3 )
+            # archive is restored when streaming fails
+            def broken():
+                yield b"data"
+                raise IOError("broken")
+            before = open(path, "rb").read()
+            zs = zipstream.ZipStream([{"stream": broken(), "name": "c.txt"}])
+            self.assertRaises( IOError, zs.append_to, path )
+            self.assertEqual( open(path, "rb").read(), before )
+            with open(path, "wb") as fo:
+                fo.write(b"not a zip file")
+            self.assertRaises( Exception, zipstream.ZipStream(new_files()).append_to, path )
+        finally:
+            os.unlink(path)
+
+    def test_dedup(self):
+        tf = self._add_temp_file(20000)
+        text = b"".join(b"%d foo bar\n" % n for n in range(5000))
+        def files():
+            return [{"file": tf, "name": "a/%d.txt" % n, "compression": "deflate"}
+                    for n in range(3)] + \
+                   [{"stream": iter([text[:100], text[100:]]), "name": "b/%d.txt" % n,
+                     "compression": "deflate"} for n in range(2)] + \
+                   [{"stream": iter([text[:100]]), "name": "c.txt", "compression": "deflate"},
+                    {"file": tf, "name": "d.txt"},
+                    {"file": tf, "name": "e.txt"}]
+        # streams have current time
+        now = mock.patch("time.time", return_value=1600000000.0)
+        now.start()
+        self.addCleanup(now.stop)
+        expected = b"".join(zipstream.ZipStream(files()).stream())
+        compressor = zipstream.zipstream.CODECS['deflate'].factory
+        for workers in (0, 2):
+            with mock.patch.dict(zipstream.zipstream.CODECS, deflate=zipstream.zipstream.CODECS['deflate']._replace(
+                    factory=mock.Mock(wraps=compressor))) as codecs:
+                zs = zipstream.ZipStream(files(), dedup=1024 * 1024, workers=workers)
+                res = b"".join(zs.stream())
+                calls = codecs['deflate'].factory.call_count
+            if not workers:
+                # entries in progress can't be reused
+                self.assertEqual( calls, 3 )
+                self.assertEqual( res, expected )
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                self.assertEqual( zf.read("a/2.txt"), open(tf, "rb").read() )
+                self.assertEqual( zf.read("b/1.txt"), text )
+                self.assertEqual( zf.read("c.txt"), text[:100] )
+        # data over limit is not kept
+        zs = zipstream.ZipStream(files(), dedup=10)
+        self.assertEqual( b"".join(zs.stream()), expected )
+        # large streams are not read ahead
+        def stream(read):
+            for n in range(100):
+                read.append(n)
+                yield text[:1000]
+        read = []
+        zs = zipstream.ZipStream([{"stream": stream(read), "name": "big.txt"}],
+                                 dedup=2500)
+        parts = zs.stream()
+        res = next(parts)
+        self.assertEqual( len(read), 3 )
+        with zipfile.ZipFile(io.BytesIO(res + b"".join(parts))) as zf:
+            self.assertEqual( zf.read("big.txt"), text[:1000] * 100 )
+
+    def test_split_files(self):
+        from concurrent import futures
+        files = [{"file": self._add_temp_file(n), "name": "%d.txt" % n}
+                 for n in (3000, 100, 2000, 4000, 10, 1500)]
+        noise = os.urandom(5000)
+        files.append({"stream": [noise], "name": "noise", "size": len(noise),
+                      "compression": "deflate"})
+        parts = zipstream.split_files(files, 6000)
+        self.assertEqual( sum(parts, []), files )
+        self.assertGreater( len(parts), 1 )
+        def stream(part):
+            return b"".join(zipstream.ZipStream(part).stream())
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            archives = list(pool.map(stream, parts))
+        names = []
+        for res in archives:
+            self.assertLessEqual( len(res), 6000 )
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                names.extend(zf.namelist())
+        self.assertEqual( names, [f["name"] for f in files] )
+        self.assertRaises( Exception, zipstream.split_files, files, 4000 )
+        self.assertRaises( Exception, zipstream.split_files,
+                           [{"stream": [b"a"], "name": "a"}], 4000 )
+        # name of directory is taken from path with trailing slash
+        import tempfile
+        top = tempfile.mkdtemp(suffix="_long_directory_name")
+        self.addCleanup(os.rmdir, top)
+        for source in ({"directory": top + "/"}, {"directory": top, "name": "dir"}):
+            res = b"".join(zipstream.ZipStream([dict(source)]).stream())
+            bound = zipstream.zipstream._entry_size_bound(source, None)
+            self.assertLessEqual( len(res) - zipstream.consts.CD_END_STRUCT.size, bound )
+
+    def test_unzip_stream(self):
+        import asyncio
+        text = b"".join(b"%d foo bar\n" % n for n in range(20000))
+        # data containing signature of descriptor
+        tricky = os.urandom(1000) + zipstream.consts.DD_MAGIC + b"x" * 20
+        files = [{"stream": [text], "name": "%s.txt" % c, "compression": c}
+                 for c in (None, "deflate", "bzip2", "lzma")]
+        files += [{"stream": [tricky], "name": "tricky.bin"},
+                  {"stream": [b""], "name": "empty"}]
+        res = b"".join(zipstream.ZipStream(files).stream())
+        expected = [(f["name"], b"".join(f["stream"])) for f in files]
+        for size in (7, 1000, len(res)):
+            chunks = [res[i:i+size] for i in range(0, len(res), size)]
+            result = [(name, b"".join(data))
+                      for name, data in zipstream.UnzipStream(chunks, 4096).stream()]
+            self.assertEqual( result, expected )
+        async def aio_chunks():
+            for i in range(0, len(res), 1000):
+                yield res[i:i+1000]
+        async def run():
+            result = []
+            async for name, data in zipstream.AioUnzipStream(aio_chunks()).stream():
+                # data of entries can be skipped
+                if name != "bzip2.txt":
+                    result.append((name, b"".join([chunk async for chunk in data])))
+            return result
+        self.assertEqual( asyncio.run(run()), expected[:2] + expected[3:] )
+        # archive with sizes in local headers
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as zf:
+            zf.writestr("a.txt", text, zipfile.ZIP_DEFLATED)
+            zf.writestr("b.txt", text)
+        result = [(name, b"".join(data))
+                  for name, data in zipstream.UnzipStream([buf.getvalue()]).stream()]
+        self.assertEqual( result, [("a.txt", text), ("b.txt", text)] )
+        # broken data and archive
+        broken = bytearray(res)
+        broken[len(res) // 2] ^= 0xff
+        self.assertRaises( Exception, list,
+                           (b"".join(d) for n, d in zipstream.UnzipStream([bytes(broken)]).stream()) )
+        self.assertRaises( Exception, list, zipstream.UnzipStream([res[:1000]]).stream() )
+
+    def test_aio_prefetch(self):
+        import asyncio
+        async def slow_stream(n):
+            for i in range(4):
+                await asyncio.sleep(0.02)
+                yield b"%d-%d " % (n, i) * 100
+        def files():
+            return [{"stream": slow_stream(n), "name": "%d.txt" % n,
+                     "compression": "deflate" if n % 2 else None} for n in range(6)]
+        async def run(**kwargs):
+            start = time.monotonic()
+            zs = zipstream.AioZipStream(files(), **kwargs)
+            # streams have current time
+            with mock.patch("time.time", return_value=1600000000.0):
+                res = b"".join([chunk async for chunk in zs.stream()])
+            return res, time.monotonic() - start
+        expected, serial = asyncio.run(run())
+        res, elapsed = asyncio.run(run(prefetch=5))
+        self.assertEqual( res, expected )
+        self.assertLess( elapsed, serial * 0.6 )
+        # limits smaller than chunks
+        res, elapsed = asyncio.run(run(prefetch=3, prefetch_limit=10,
+                                       prefetch_entry_limit=10))
+        self.assertEqual( res, expected )
+        async def broken():
+            yield b"data"
+            raise IOError("broken")
+        async def run_broken():
+            zs = zipstream.AioZipStream([{"stream": slow_stream(0), "name": "a"},
+                                         {"stream": broken(), "name": "b"}], prefetch=2)
+            return [chunk async for chunk in zs.stream()]
+        self.assertRaises( IOError, asyncio.run, run_broken() )
+
+    def test_walk_files(self):
+        import shutil, tempfile
+        top = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(top, "sub", "deep"))
+            os.makedirs(os.path.join(top, "skip"))
+            for name, mode in (("a.txt", 0o644), ("run.sh", 0o755), ("sub/b.txt", 0o600),
+                               ("sub/deep/c.txt", 0o644), ("sub/d.log", 0o644),
+                               ("skip/e.txt", 0o644)):
+                path = os.path.join(top, name)
+                with open(path, "wb") as fo:
+                    fo.write(name.encode() * 10)
+                os.chmod(path, mode)
+                os.utime(path, (1600000000, 1600000000))
+            sources = list(zipstream.walk_files(top, prefix="root/", exclude=["skip"],
+                                                include=["*.txt", "*.sh"]))
+            # all data is taken from walk
+            with mock.patch("os.stat", side_effect=AssertionError("stat")):
+                zs = zipstream.ZipStream(sources)
+                size = zs.total_size()
+                res = b"".join(zs.stream())
+            self.assertEqual( len(res), size )
+            with zipfile.ZipFile(io.BytesIO(res)) as zf:
+                self.assertIsNone( zf.testzip() )
+                self.assertEqual( zf.namelist(), ["root/a.txt", "root/run.sh", "root/sub/",
+                                                  "root/sub/b.txt", "root/sub/deep/",
+                                                  "root/sub/deep/c.txt"] )
+                self.assertTrue( zf.getinfo("root/sub/").is_dir() )
+                for info in zf.infolist():
+                    # extractors use attributes of unix system only
+                    self.assertEqual( info.create_system, 3 )
+                    self.assertEqual( info.create_version, 20 )
+                self.assertEqual( zf.getinfo("root/run.sh").external_attr >> 16 & 0o777, 0o755 )
+                self.assertEqual( zf.getinfo("root/sub/b.txt").external_attr >> 16 & 0o777, 0o600 )
+                self.assertEqual( zf.getinfo("root/a.txt").date_time,
+                                  time.localtime(1600000000)[:6] )
+                self.assertEqual( zf.read("root/sub/deep/c.txt"), b"sub/deep/c.txt" * 10 )
+        finally:
+            shutil.rmtree(top)
+
+    def test_budget(self):
+        import asyncio, threading
+        files = [{"file": self._add_temp_file(20000 + n), "name": "%d.txt" % n,
+                  "compression": "deflate" if n % 3 else None} for n in range(6)]
+        expected = b"".join(zipstream.ZipStream(files).stream())
+        budget = zipstream.Budget(max_buffers=150000, max_compressors=1, max_workers=3)
+        results = []
+        def run(**kwargs):
+            results.append(b"".join(zipstream.ZipStream(files, budget=budget,
+                                                        **kwargs).stream()))
+        threads = [threading.Thread(target=run, kwargs=kwargs)
+                   for kwargs in ({}, {"workers": 2, "buffer_limit": 100000},
+                                  {"workers": 3, "buffer_limit": 100000},
+                                  {"read_ahead": 4})]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual( results, [expected] * 4 )
+        stats = budget.stats()
+        for resource in ("buffers", "compressors", "workers"):
+            self.assertEqual( stats[resource]["used"], 0 )
+            self.assertLessEqual( stats[resource]["peak"], stats[resource]["limit"] )
+        self.assertGreater( stats["compressors"]["waits"], 0 )
+        self.assertGreater( stats["buffers"]["waits"], 0 )
+        # all threads of stream are reserved, interrupted stream returns them
+        for kwargs, threads in (({"workers": 2}, 2), ({"read_ahead": 2}, 1),
+                                ({"block_workers": 2}, 2),
+                                ({"workers": 2, "block_workers": 1}, 3)):
+            parts = zipstream.ZipStream(files, budget=budget, **kwargs).stream()
+            next(parts)
+            self.assertEqual( budget.stats()["workers"]["used"], threads )
+            parts.close()
+            self.assertEqual( budget.stats()["workers"]["used"], 0 )
+        # stream with more threads than allowed is rejected
+        parts = zipstream.ZipStream(files, workers=4, budget=budget).stream()
+        self.assertRaises( Exception, next, parts )
+        self.assertEqual( budget.stats()["buffers"]["used"], 0 )
+        budget = zipstream.Budget(max_workers=3)
+        async def run_aio():
+            async def stream():
+                zs = zipstream.AioZipStream(files, budget=budget, offload_size=4096)
+                return b"".join([chunk async for chunk in zs.stream()])
+            return await asyncio.gather(*[stream() for i in range(3)])
+        self.assertEqual( asyncio.run(run_aio()), [expected] * 3 )
+        stats = budget.stats()
+        self.assertEqual( stats["workers"]["used"], 0 )
+        # each stream reserves thread of read and of compression,
+        # so only one of them fits into budget at once
+        self.assertEqual( stats["workers"]["peak"], 2 )
+        self.assertEqual( stats["workers"]["waits"], 2 )
+        budget.shutdown()
+
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,15 @@
-from .zipstream import ZipStream
+from .zipstream import ZipStream, split_files
+from .unzipstream import UnzipStream
+from .walk import walk_files
+from .cache import EntryCache
+from .observer import Observer
+from .budget import Budget
 import sys
 
 # AioZipStream is avilable from Python 3.6 version
 if (sys.version_info.major >= 3) and (sys.version_info.minor >= 6):
     from .aiozipstream import AioZipStream
+    from .aiounzipstream import AioUnzipStream
 del sys
 
 version = "0.4"
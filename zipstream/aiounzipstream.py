@@ -0,0 +1,52 @@
+#
+# ZIP File stream reading
+# based on official ZIP File Format Specification version 6.3.4
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+#
+from .unzipstream import UnzipStream, _UnzipParser
+
+
+__all__ = ("AioUnzipStream",)
+
+
+class AioUnzipStream(UnzipStream):
+    """
+    Asynchronous version of UnzipStream, reading archive
+    from asynchronous iterable
+    """
+
+    async def _events(self):
+        parser = _UnzipParser(self.chunksize)
+        src = self.chunks.__aiter__()
+        while True:
+            event = parser.next_event()
+            if event is not None:
+                yield event
+            elif parser.done:
+                return
+            else:
+                try:
+                    chunk = await src.__anext__()
+                except StopAsyncIteration:
+                    parser.finish()
+                parser.feed(chunk)
+
+    async def _entry_data(self, events):
+        async for kind, value in events:
+            if kind != 'data':
+                return
+            yield value
+
+    async def stream(self):
+        """
+        Stream entries of archive, as tuples of name and asynchronous
+        iterator of its data. Data must be read before next entry,
+        otherwise it is skipped.
+        """
+        events = self._events()
+        async for kind, value in events:
+            data = self._entry_data(events)
+            yield value, data
+            # skip not read data
+            async for chunk in data:
+                pass
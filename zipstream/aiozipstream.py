@@ -4,8 +4,13 @@
 # https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
 #
 import asyncio
-from .zipstream import ZipBase, Processor
-from concurrent import futures
+import os
+import time
+from collections import deque
+from . import consts
+from .observer import ArchiveStats
+from .zipstream import ZipBase, FilePart, _Coalescer, \
+    _stored_by_name, _compressible
 try:
     import aiofiles
     aio_available = True
@@ -16,34 +21,211 @@ except ImportError:
 __all__ = ("AioZipStream",)
 
 
+def _read_sample(path, size):
+    with open(path, "rb") as fh:
+        return fh.read(size)
+
+
+async def _timed_data(data, stats):
+    """
+    Pass data through, measuring time of reading it
+    """
+    data = data.__aiter__()
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = await data.__anext__()
+        except StopAsyncIteration:
+            stats.read_time += time.perf_counter() - start
+            return
+        stats.read_time += time.perf_counter() - start
+        yield chunk
+
+
+async def _aio_chain(chunks, src):
+    for chunk in chunks:
+        yield chunk
+    async for chunk in src:
+        yield chunk
+
+
+async def _aio_peek(src, size):
+    """
+    Read at least size bytes from beginning of asynchronous stream.
+    Returns read data and stream which yields all data again
+    """
+    src = src.__aiter__()
+    chunks = []
+    length = 0
+    while length < size:
+        try:
+            chunk = await src.__anext__()
+        except StopAsyncIteration:
+            break
+        chunks.append(chunk)
+        length += len(chunk)
+    return b''.join(chunks)[:size], _aio_chain(chunks, src)
+
+
+class _PrefetchPool:
+    """
+    Limits of data prefetched from stream sources, shared by
+    all buffers of single archive
+    """
+
+    def __init__(self, limit, entry_limit):
+        self.limit = limit
+        self.entry_limit = entry_limit
+        self.size = 0
+        self.cond = asyncio.Condition()
+
+    def prefetch(self, src):
+        return _PrefetchBuffer(self, src)
+
+
+class _PrefetchBuffer:
+    """
+    Buffer of chunks of stream source, filled ahead by separate task.
+    At least one chunk can be always buffered, so entry which is
+    streamed does not wait for buffers of next entries.
+    """
+
+    def __init__(self, pool, src):
+        self.pool = pool
+        self.chunks = deque()
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.task = asyncio.ensure_future(self._fill(src))
+
+    def _has_room(self, length):
+        return not self.chunks or (
+            self.size + length <= self.pool.entry_limit
+            and self.pool.size + length <= self.pool.limit)
+
+    async def _fill(self, src):
+        cond = self.pool.cond
+        try:
+            async for chunk in src:
+                async with cond:
+                    await cond.wait_for(lambda: self._has_room(len(chunk)))
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                    self.pool.size += len(chunk)
+                    cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with cond:
+                self.done = True
+                cond.notify_all()
+
+    async def data(self):
+        """
+        chunks of source, as they are buffered
+        """
+        cond = self.pool.cond
+        while True:
+            async with cond:
+                await cond.wait_for(lambda: self.chunks or self.done)
+                if self.chunks:
+                    chunk = self.chunks.popleft()
+                    self.size -= len(chunk)
+                    self.pool.size -= len(chunk)
+                    cond.notify_all()
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield chunk
+
+    def cancel(self):
+        self.task.cancel()
+        self.pool.size -= self.size
+        self.chunks.clear()
+        self.size = 0
+
+
 class AioZipStream(ZipBase):
     """
     Asynchronous version of ZipStream
     """
 
     def __init__(self, *args, **kwargs):
+        """
+        executor - (optional) executor used to compress data and read files
+                   in background. Default executor of event loop is used if
+                   not set, so threads are shared by all streams. If budget
+                   is set, its executor is used instead, and files are
+                   read in executor too.
+        offload_size - chunks of compressed data are gathered into batches
+                       of this size, before processing them in executor.
+                       Smaller entries and not compressed data are
+                       processed directly in event loop.
+        read_ahead - number of reads of file kept in progress in executor,
+                     while data is consumed. Each read is of offload_size
+                     or chunksize bytes, whichever is larger. It is also
+                     used if aiofiles is not available, with single read
+                     in progress when not set.
+        prefetch - number of next entries, which stream sources are read
+                   concurrently into buffers, while current entry
+                   is streamed. 0 turns it off.
+        prefetch_limit - max size of prefetched data of all entries
+        prefetch_entry_limit - max size of prefetched data of single entry
+        Rest of parameters is the same as for ZipStream
+        """
+        self.executor = kwargs.pop('executor', None)
+        self.offload_size = kwargs.pop('offload_size', 64 * 1024)
+        self.read_ahead = kwargs.pop('read_ahead', 0)
+        self.prefetch = kwargs.pop('prefetch', 0)
+        self.prefetch_limit = kwargs.pop('prefetch_limit', 16 * 1024 * 1024)
+        self.prefetch_entry_limit = kwargs.pop('prefetch_entry_limit', 1024 * 1024)
         super(AioZipStream, self).__init__(*args, **kwargs)
 
-    def __get_executor(self):
-        # get thread pool executor
-        try:
-            return self.__tpex
-        except AttributeError:
-            self.__tpex = futures.ThreadPoolExecutor(max_workers=1)
-            return self.__tpex
-
-    async def _execute_aio_task(self, task, *args, **kwargs):
+    async def _execute_aio_task(self, task, *args):
         # run synchronous task in separate thread and await for result
+        # threads are reserved in budget before stream starts
+        executor = self.executor
+        if executor is None and self.budget is not None:
+            executor = self.budget.executor
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.__get_executor(),
-                                          task, *args, **kwargs)
+        return await loop.run_in_executor(executor, task, *args)
+
+    def _buffers_size(self):
+        size = super(AioZipStream, self)._buffers_size() + self.offload_size
+        size += self.read_ahead * max(self.chunksize, self.offload_size)
+        if self.prefetch:
+            size += self.prefetch_limit
+        return size
 
-    def _create_file_struct(self, data):
-        if 'file' in data:
-            if not aio_available:
-                raise Exception(
-                    "aiofiles module is required to stream files asynchronously")
-        return super(AioZipStream, self)._create_file_struct(data)
+    def _threads(self):
+        # reads in progress, and task of compression
+        reads = max(self.read_ahead, 1)
+        return super(AioZipStream, self)._threads() + reads + 1
+
+    async def _resolve_auto(self, source):
+        """
+        Choose compression method of entry with 'auto' compression,
+        returns copy of source with chosen method. Sample of data is read
+        here, so it can't be done by _create_file_struct.
+        """
+        if 'directory' in source:
+            return dict(source, compression=None)
+        name = source.get('name') or os.path.basename(source['file'])
+        if _stored_by_name(name):
+            return dict(source, compression=None)
+        if 'file' in source:
+            sample = await self._execute_aio_task(
+                _read_sample, source['file'], consts.AUTO_SAMPLE_SIZE)
+            stream = None
+        else:
+            sample, stream = await _aio_peek(source['stream'],
+                                             consts.AUTO_SAMPLE_SIZE)
+        source = dict(source, compression='deflate'
+                      if _compressible(sample) else None)
+        if stream is not None:
+            source['stream'] = stream
+        return source
 
     async def data_generator(self, src, src_type):
         if src_type == 's':
@@ -51,6 +233,11 @@ class AioZipStream(ZipBase):
                 yield chunk
             return
         if src_type == 'f':
+            # files are read in executor when threads are budgeted
+            if self.read_ahead or self.budget is not None or not aio_available:
+                async for chunk in self._read_ahead_file(src):
+                    yield chunk
+                return
             async with aiofiles.open(src, "rb") as fh:
                 while True:
                     part = await fh.read(self.chunksize)
@@ -59,32 +246,301 @@ class AioZipStream(ZipBase):
                     yield part
             return
 
+    async def _read_ahead_file(self, path):
+        """
+        Read file with os.pread in executor, keeping next reads
+        in progress while data is consumed
+        """
+        size = max(self.chunksize, self.offload_size)
+        depth = max(self.read_ahead, 1)
+        fh = await self._execute_aio_task(open, path, "rb")
+        pending = deque()
+        try:
+            fd = fh.fileno()
+            offset = 0
+            while True:
+                while len(pending) < depth:
+                    pending.append(asyncio.ensure_future(
+                        self._execute_aio_task(os.pread, fd, size, offset)))
+                    offset += size
+                chunk = await pending.popleft()
+                if chunk:
+                    yield chunk
+                if len(chunk) < size:
+                    # end of file
+                    break
+        finally:
+            # reads in threads can't be cancelled,
+            # they must be finished before file is closed
+            await asyncio.gather(*pending, return_exceptions=True)
+            fh.close()
+
     async def _stream_single_file(self, file_struct):
         """
         stream single zip file with header and descriptor at the end
         """
         yield self._make_local_file_header(file_struct)
-        pcs = Processor(file_struct)
-        async for chunk in self.data_generator(file_struct['src'], file_struct['stype']):
-            yield await self._execute_aio_task(pcs.process, chunk)
-        chunk = await self._execute_aio_task(pcs.tail)
-        # chunk = await pcs.aio_tail()
+        pcs = self._make_processor(file_struct)
+        data = self.data_generator(file_struct.src, file_struct.stype)
+        if file_struct.stats is not None:
+            data = _timed_data(data, file_struct.stats)
+        if file_struct.cmethod is None:
+            # only crc is calculated, it is not worth of thread switch
+            async for chunk in data:
+                yield pcs.process(chunk)
+            yield self._make_data_descriptor(file_struct, *pcs.state())
+            return
+        # block processor waits for its own workers
+        inline = not self._block_processed(file_struct)
+        ticket = self._compressor_request(file_struct)
+        if ticket is not None:
+            await ticket.wait_async()
+        writer = self._cache_writer(file_struct)
+        try:
+            batch, size = [], 0
+            async for chunk in data:
+                batch.append(chunk)
+                size += len(chunk)
+                if size < self.offload_size:
+                    continue
+                chunk = await self._execute_aio_task(
+                    self._process_batch, pcs, writer, b''.join(batch))
+                batch, size = [], 0
+                if len(chunk) > 0:
+                    yield chunk
+            # last batch is smaller than offload_size
+            if inline:
+                chunk = self._process_batch(pcs, writer, b''.join(batch), True)
+            else:
+                chunk = await self._execute_aio_task(
+                    self._process_batch, pcs, writer, b''.join(batch), True)
+            if writer is not None:
+                self._cache_commit(file_struct, writer, pcs.state())
+        finally:
+            if writer is not None:
+                writer.abort()
+            if ticket is not None:
+                ticket.release()
         if len(chunk) > 0:
             yield chunk
         yield self._make_data_descriptor(file_struct, *pcs.state())
 
-    async def stream(self):
-        # stream files
-        for idx, source in enumerate(self._source_of_files):
-            file_struct = self._create_file_struct(source)
-            # file offset in archive
-            file_struct['offset'] = self._offset_get()
-            self._add_file_to_cdir(file_struct)
-            # file data
-            async for chunk in self._stream_single_file(file_struct):
-                self._offset_add(len(chunk))
+    @staticmethod
+    def _process_batch(pcs, writer, chunk, last=False):
+        # process batch of data, and finish processing after last one
+        chunk = pcs.process(chunk)
+        if last:
+            chunk += pcs.tail()
+        if writer is not None:
+            writer.write(chunk)
+        return chunk
+
+    async def _read_file_part(self, part):
+        """
+        read data of FilePart
+        """
+        size = part.size
+        fh = await self._execute_aio_task(part.open)
+        try:
+            await self._execute_aio_task(fh.seek, part.offset)
+            while size > 0:
+                chunk = await self._execute_aio_task(
+                    fh.read, min(size, self.chunksize))
+                if not chunk:
+                    raise Exception("File %r changed during streaming" % part.path)
+                size -= len(chunk)
                 yield chunk
-        # stream zip structures
-        for chunk in self._make_end_structures():
-            yield chunk
-        self._cleanup()
+        finally:
+            fh.close()
+
+    async def _stream_cached_file(self, file_struct, entry, file_parts=False):
+        """
+        stream single zip file, which compressed data is found in cache
+        """
+        try:
+            yield self._make_local_file_header(file_struct)
+            part = FilePart(entry.path, entry.offset, entry.csize, entry.fh)
+            if file_parts:
+                yield part
+            else:
+                async for chunk in self._read_file_part(part):
+                    yield chunk
+        finally:
+            if entry.fh is not None:
+                entry.fh.close()
+        yield self._make_data_descriptor(file_struct, entry.crc,
+                                         entry.size, entry.csize)
+
+    async def _stream_file_part(self, file_struct):
+        """
+        stream not compressed file with data as single FilePart
+        """
+        size = file_struct.fsize
+        yield self._make_local_file_header(file_struct)
+        yield FilePart(file_struct.src, 0, size)
+        crc = await self._execute_aio_task(self._file_crc, file_struct)
+        yield self._make_data_descriptor(file_struct, crc, size, size)
+
+    def stream(self):
+        """
+        Stream complete archive
+        """
+        parts = self._archive_parts()
+        if self.write_size:
+            parts = self._coalesce(parts)
+        if self.observer is not None:
+            parts = self._observed(parts)
+        return parts
+
+    async def _observed(self, parts):
+        # pass streamed archive through, notifying observer
+        stats = self._archive_stats = ArchiveStats()
+        self.observer.archive_start(stats)
+        async for part in parts:
+            if stats.ttfb is None:
+                stats.ttfb = time.perf_counter() - stats.start
+                self.observer.first_byte(stats)
+            stats.total_bytes += len(part)
+            yield part
+        stats.end = time.perf_counter()
+        self._archive_stats = None
+        self.observer.archive_end(stats)
+
+    async def _coalesce(self, chunks):
+        # stream chunks gathered into larger ones
+        buf = _Coalescer(self.write_size, self.flush_interval)
+        async for chunk in chunks:
+            for out in buf.add(chunk):
+                yield out
+        if buf.pos:
+            yield buf.flush()
+
+    async def _prefetched_sources(self):
+        """
+        Sources of files, stream sources of next entries
+        are read ahead concurrently
+        """
+        pool = _PrefetchPool(self.prefetch_limit, self.prefetch_entry_limit)
+        sources = iter(self._source_of_files)
+        ahead = deque()
+        current = None
+        try:
+            while True:
+                # current entry and prefetched ones
+                while len(ahead) <= self.prefetch:
+                    source = next(sources, None)
+                    if source is None:
+                        break
+                    buf = None
+                    if 'stream' in source:
+                        buf = pool.prefetch(source['stream'])
+                        source = dict(source, stream=buf.data())
+                    ahead.append((source, buf))
+                if not ahead:
+                    return
+                source, current = ahead.popleft()
+                yield source
+        finally:
+            if current is not None:
+                current.cancel()
+            for source, buf in ahead:
+                if buf is not None:
+                    buf.cancel()
+
+    async def _sources(self):
+        if self.prefetch:
+            async for source in self._prefetched_sources():
+                yield source
+        else:
+            for source in self._source_of_files:
+                yield source
+
+    async def _archive_parts(self, file_parts=False):
+        # wait for buffers and workers of budget, before stream starts
+        tickets = []
+        requests = []
+        if self.budget is not None:
+            requests = self._admission_requests()
+        try:
+            for resource, amount in requests:
+                tickets.append(await self.budget.acquire_async(resource, amount))
+            self._start_block_executor()
+            # stream files
+            async for source in self._sources():
+                if source.get('compression') == 'auto':
+                    source = await self._resolve_auto(source)
+                file_struct = self._create_file_struct(source)
+                # file offset in archive
+                file_struct.offset = self._offset_get()
+                if self.observer is not None:
+                    self._file_started(file_struct)
+                # file data
+                entry = self._cached_entry(file_struct)
+                if file_parts and self._is_plain_file(file_struct):
+                    chunks = self._stream_file_part(file_struct)
+                elif entry is not None:
+                    chunks = self._stream_cached_file(file_struct, entry, file_parts)
+                else:
+                    chunks = self._stream_single_file(file_struct)
+                async for chunk in chunks:
+                    self._offset_add(len(chunk))
+                    yield chunk
+                self._file_streamed(file_struct)
+                self._add_file_to_cdir(file_struct)
+            # stream zip structures
+            for chunk in self._make_end_structures():
+                yield chunk
+            self._cleanup()
+        finally:
+            self._shutdown_block_executor()
+            for ticket in tickets:
+                ticket.release()
+
+    async def write_to(self, writer, high_water=64 * 1024):
+        """
+        Stream complete archive into asyncio.StreamWriter, or other object
+        with writelines method and drain coroutine. Parts of archive are
+        gathered and written with single writelines call, and drain is
+        awaited only when high_water bytes are written since last one.
+        Returns number of bytes written.
+        """
+        total = pending = 0
+        batch = []
+        parts = self._archive_parts()
+        if self.observer is not None:
+            parts = self._observed(parts)
+        async for part in parts:
+            batch.append(part)
+            pending += len(part)
+            if pending >= high_water:
+                writer.writelines(batch)
+                total += pending
+                batch, pending = [], 0
+                await writer.drain()
+        writer.writelines(batch)
+        await writer.drain()
+        return total + pending
+
+    async def stream_to(self, sock):
+        """
+        Stream complete archive into non blocking socket.
+        Data of not compressed files is sent with loop.sock_sendfile,
+        without copying it through python.
+        Returns number of bytes written.
+        """
+        loop = asyncio.get_event_loop()
+        total = 0
+        parts = self._archive_parts(file_parts=True)
+        if self.observer is not None:
+            parts = self._observed(parts)
+        async for part in parts:
+            if isinstance(part, FilePart):
+                with part.open() as fh:
+                    sent = await loop.sock_sendfile(sock, fh, part.offset,
+                                                    part.size)
+                if sent != part.size:
+                    raise Exception("File %r changed during streaming" % part.path)
+            else:
+                await loop.sock_sendall(sock, part)
+            total += len(part)
+        return total
@@ -0,0 +1,206 @@
+#
+# Limits of resources shared by many streams
+#
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+__all__ = ("Budget", )
+
+
+RESOURCES = ('buffers', 'compressors', 'workers')
+
+
+class _Ticket:
+    """
+    Request of resource. It is granted in order of requests, when
+    enough of resource is free, and released by owner after use.
+    """
+
+    def __init__(self, budget, resource, amount):
+        self.budget = budget
+        self.resource = resource
+        self.amount = amount
+        self.requested = time.monotonic()
+        self.granted = self.released = False
+        self.event = self.future = self.loop = None
+
+    def _wake(self):
+        # called with lock of budget held, when request is
+        # granted or withdrawn
+        if self.event is not None:
+            self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._set_future)
+
+    def _set_future(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+    def wait(self):
+        """
+        block until resource is granted
+        """
+        with self.budget._lock:
+            if self.granted or self.released:
+                return self
+            self.event = threading.Event()
+        self.event.wait()
+        return self
+
+    async def wait_async(self):
+        """
+        wait until resource is granted, without blocking event loop
+        """
+        with self.budget._lock:
+            if self.granted or self.released:
+                return self
+            self.loop = asyncio.get_running_loop()
+            self.future = self.loop.create_future()
+        try:
+            await self.future
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        return self
+
+    def release(self):
+        """
+        return granted resource, or withdraw request.
+        Waiting owner of withdrawn request is woken up.
+        """
+        self.budget._release(self)
+
+
+class Budget:
+    """
+    Limits of resources shared by many ZipStream and AioZipStream
+    instances: size of buffers, number of compressors and number of
+    worker threads in use. Streams wait for resources when limits are
+    reached, in order of their requests, so archives are streamed
+    slower instead of running out of memory.
+    Budget can be used from many threads and event loops.
+    """
+
+    def __init__(self, max_buffers=None, max_compressors=None, max_workers=None):
+        """
+        max_buffers - (optional) max size of buffers of all streams in bytes.
+                      Stream reserves size of its buffers before it starts,
+                      streams which do not fit wait for others.
+        max_compressors - (optional) max number of entries compressed at once
+        max_workers - (optional) max number of worker threads of all streams.
+                      Stream reserves its threads before it starts, stream
+                      which needs more of them than this is rejected.
+                      Thread pool of this size is shared by asynchronous
+                      streams, if they have no own executor.
+        """
+        self.limits = {'buffers': max_buffers,
+                       'compressors': max_compressors,
+                       'workers': max_workers}
+        self.used = dict.fromkeys(RESOURCES, 0)
+        self.peak = dict.fromkeys(RESOURCES, 0)
+        self.waits = dict.fromkeys(RESOURCES, 0)
+        self.wait_time = dict.fromkeys(RESOURCES, 0.0)
+        self.__queues = {resource: deque() for resource in RESOURCES}
+        self._lock = threading.Lock()
+        self.__executor = None
+
+    @property
+    def executor(self):
+        """
+        thread pool shared by asynchronous streams
+        """
+        with self._lock:
+            if self.__executor is None:
+                from concurrent import futures
+                self.__executor = futures.ThreadPoolExecutor(
+                    max_workers=self.limits['workers'])
+            return self.__executor
+
+    def request(self, resource, amount=1):
+        """
+        Request resource, it is granted at once if possible. Returns
+        ticket, which should be waited for, and released after use.
+        Requests are granted in order, so ticket keeps its place in queue
+        even if it is waited for later.
+        """
+        limit = self.limits[resource]
+        if limit is not None:
+            # request larger than limit is granted when nothing is used
+            amount = min(amount, limit)
+        ticket = _Ticket(self, resource, amount)
+        with self._lock:
+            queue = self.__queues[resource]
+            if not queue and self.__fits(resource, amount):
+                self.__use(ticket)
+            else:
+                self.waits[resource] += 1
+                queue.append(ticket)
+        return ticket
+
+    def acquire(self, resource, amount=1):
+        """
+        wait for resource, returns ticket which should be released
+        """
+        return self.request(resource, amount).wait()
+
+    async def acquire_async(self, resource, amount=1):
+        """
+        wait for resource in event loop, returns ticket
+        which should be released
+        """
+        return await self.request(resource, amount).wait_async()
+
+    def __fits(self, resource, amount):
+        limit = self.limits[resource]
+        return limit is None or self.used[resource] + amount <= limit
+
+    def __use(self, ticket):
+        self.used[ticket.resource] += ticket.amount
+        self.peak[ticket.resource] = max(self.peak[ticket.resource],
+                                         self.used[ticket.resource])
+        ticket.granted = True
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self.used[ticket.resource] -= ticket.amount
+            else:
+                self.__queues[ticket.resource].remove(ticket)
+                ticket._wake()
+            # grant waiting requests in order
+            queue = self.__queues[ticket.resource]
+            while queue and self.__fits(ticket.resource, queue[0].amount):
+                waiting = queue.popleft()
+                self.__use(waiting)
+                self.wait_time[waiting.resource] += \
+                    time.monotonic() - waiting.requested
+                waiting._wake()
+
+    def stats(self):
+        """
+        current utilization of resources: used amount, its limit and peak,
+        number of waiting requests, and number and total time of waits
+        """
+        with self._lock:
+            return {resource: {"used": self.used[resource],
+                               "limit": self.limits[resource],
+                               "peak": self.peak[resource],
+                               "waiting": len(self.__queues[resource]),
+                               "waits": self.waits[resource],
+                               "wait_time": self.wait_time[resource]}
+                    for resource in RESOURCES}
+
+    def shutdown(self):
+        """
+        shut down shared thread pool
+        """
+        with self._lock:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,266 @@
+#
+# Cache of compressed entries
+#
+import os
+import hashlib
+import struct
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import namedtuple
+
+
+__all__ = ("EntryCache", )
+
+
+# header of cached entry file, compressed data goes after it
+CACHE_STRUCT = struct.Struct(b"<4sLQQ")
+CACHE_MAGIC = b'ZSC1'
+CACHE_SUFFIX = '.zsc'
+
+# fh is cached file opened by EntryCache.get, so it can be read
+# even if it is removed from cache before entry is streamed
+CachedEntry = namedtuple("CachedEntry",
+                         ("path", "offset", "crc", "size", "csize", "fh"))
+
+# data of deduplicated entry is kept in memory up to this size
+DEDUP_SPOOL_SIZE = 1024 * 1024
+
+
+class _CacheWriter:
+    """
+    Writes compressed data of single entry into temporary file,
+    which is moved into cache when all data is written
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        fd, self.tmp = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self.fh = os.fdopen(fd, "wb")
+        # header is written when crc and sizes are known
+        self.fh.write(b'\x00' * CACHE_STRUCT.size)
+        self.written = 0
+
+    def write(self, chunk):
+        if self.fh is None:
+            return
+        self.written += len(chunk)
+        if self.written > self.cache.max_size:
+            # it will never fit
+            self.abort()
+            return
+        self.fh.write(chunk)
+
+    def commit(self, crc, size, csize):
+        if self.fh is None:
+            return
+        self.fh.seek(0)
+        self.fh.write(CACHE_STRUCT.pack(CACHE_MAGIC, crc & 0xffffffff,
+                                        size, csize))
+        self.fh.close()
+        self.fh = None
+        self.cache._add(self.tmp, self.key, CACHE_STRUCT.size + csize)
+
+    def abort(self):
+        if self.fh is None:
+            return
+        self.fh.close()
+        self.fh = None
+        try:
+            os.unlink(self.tmp)
+        except OSError:
+            pass
+
+
+class EntryCache:
+    """
+    Cache of compressed files, stored on local disk.
+    Entries are identified by path, size, modification time and inode
+    of file, and by compression settings. Least recently used entries
+    are removed when size of cache exceeds max_size.
+    """
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        """
+        directory - directory where compressed files are stored,
+                    it is created if not exists
+        max_size - max size of all cached files in bytes
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = self.misses = self.evictions = 0
+        self.__lock = threading.Lock()
+        self.size = sum(size for path, mtime, size in self.__entries())
+
+    def __entries(self):
+        # all cached files with their last use time and size
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                stats = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, stats.st_mtime, stats.st_size
+
+    def _key(self, file_struct):
+        path, size, mtime_ns, inode = file_struct.fkey
+        key = "%s\0%d\0%d\0%d\0%d\0%d" % (os.path.abspath(path), size, mtime_ns,
+                                          inode, file_struct.cmpr_id,
+                                          file_struct.clevel)
+        return hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def get(self, file_struct):
+        """
+        Find compressed file in cache, returns CachedEntry or None.
+        Cached file is kept open in entry, and should be closed
+        when entry is streamed.
+        """
+        path = self._path(self._key(file_struct))
+        fh = None
+        try:
+            fh = open(path, "rb")
+            head = fh.read(CACHE_STRUCT.size)
+            length = os.fstat(fh.fileno()).st_size
+        except (IOError, OSError):
+            head = b''
+        if len(head) == CACHE_STRUCT.size:
+            magic, crc, size, csize = CACHE_STRUCT.unpack(head)
+            if magic == CACHE_MAGIC and length == CACHE_STRUCT.size + csize:
+                # mark as recently used
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                with self.__lock:
+                    self.hits += 1
+                return CachedEntry(path, CACHE_STRUCT.size, crc, size, csize, fh)
+        if fh is not None:
+            fh.close()
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def writer(self, file_struct):
+        """
+        Create writer of compressed data, which adds it to cache
+        """
+        return _CacheWriter(self, self._key(file_struct))
+
+    def _add(self, tmp, key, size):
+        os.replace(tmp, self._path(key))
+        with self.__lock:
+            self.size += size
+            if self.size > self.max_size:
+                self.__evict()
+
+    def __evict(self):
+        # cache can be shared by many processes, so files are checked again
+        entries = sorted(self.__entries(), key=lambda e: e[1])
+        self.size = sum(e[2] for e in entries)
+        for path, mtime, size in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        counters of cache usage
+        """
+        with self.__lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": self.size,
+                    "max_size": self.max_size}
+
+
+class _DedupWriter:
+    """
+    Gathers compressed data of single entry, which is added
+    to DedupStore when all data is written
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.fh = tempfile.SpooledTemporaryFile(max_size=DEDUP_SPOOL_SIZE)
+        self.written = 0
+
+    def write(self, chunk):
+        if self.fh is None:
+            return
+        self.written += len(chunk)
+        if self.written > self.store.limit:
+            self.abort()
+            return
+        self.fh.write(chunk)
+
+    def commit(self, crc, size, csize):
+        if self.fh is None:
+            return
+        self.fh.seek(0)
+        self.store._add(self.fh, self.key, crc, size, csize)
+        self.abort()
+
+    def abort(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class _DedupStore:
+    """
+    Compressed data of entries of single archive, kept in temporary file,
+    so entries with the same content are compressed only once.
+    Data of entries is not added when its total size exceeds limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = {}
+        self.directory = tempfile.mkdtemp(prefix="zipstream_dedup_")
+        self.path = os.path.join(self.directory, "data")
+        self.fh = open(self.path, "wb")
+        self.__lock = threading.Lock()
+        # file is removed even if streaming was not finished
+        self.__finalizer = weakref.finalize(self, shutil.rmtree,
+                                            self.directory, True)
+
+    def get(self, key):
+        """
+        Find data of entry, returns CachedEntry or None
+        """
+        with self.__lock:
+            return self.entries.get(key)
+
+    def writer(self, key):
+        return _DedupWriter(self, key)
+
+    def _add(self, src, key, crc, size, csize):
+        with self.__lock:
+            if key in self.entries or self.size + csize > self.limit:
+                return
+            offset = self.size
+            shutil.copyfileobj(src, self.fh)
+            self.fh.flush()
+            self.size += csize
+            self.entries[key] = CachedEntry(self.path, offset,
+                                            crc & 0xffffffff, size, csize, None)
+
+    def close(self):
+        self.fh.close()
+        self.__finalizer()
@@ -5,8 +5,14 @@ import struct
 # zip constants
 ZIP32_VERSION = 20
 ZIP64_VERSION = 45
+BZIP2_VERSION = 46
+LZMA_VERSION = 63
 ZIP32_LIMIT = (1 << 31) - 1
+ZIP32_ENTRIES_LIMIT = 0xffff
 UTF8_FLAG = 0x800   # utf-8 filename encoding flag
+MSDOS_DIR_ATTR = 0x10  # directory flag of external attributes
+UNIX_SYSTEM = 0x03  # host system in high byte of version made by
+LZMA_EOS_FLAG = 0x02  # lzma stream is terminated by end of stream marker
 
 # zip compression methods
 COMPRESSION_STORE = 0
@@ -14,6 +20,35 @@ COMPRESSION_DEFLATE = 8
 COMPRESSION_BZIP2 = 12
 COMPRESSION_LZMA = 14
 
+# 'auto' compression method
+AUTO_SAMPLE_SIZE = 64 * 1024
+# files with these extensions are already compressed
+STORED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.7z', '.rar', '.zst', '.lz4',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub'))
+# signatures of compressed formats, as (offset, magic bytes)
+STORED_MAGIC = (
+    (0, b'\xff\xd8\xff'),  # jpeg
+    (0, b'\x89PNG'),
+    (0, b'GIF8'),
+    (8, b'WEBP'),
+    (4, b'ftyp'),  # mp4, mov, heic
+    (0, b'ID3'),  # mp3
+    (0, b'OggS'),
+    (0, b'fLaC'),
+    (0, b'\x1a\x45\xdf\xa3'),  # mkv, webm
+    (0, b'PK\x03\x04'),  # zip
+    (0, b'\x1f\x8b'),  # gzip
+    (0, b'BZh'),
+    (0, b'\xfd7zXZ\x00'),
+    (0, b"7z\xbc\xaf'\x1c"),
+    (0, b'Rar!'),
+    (0, b'\x28\xb5\x2f\xfd'),  # zstd
+    (0, b'\x04\x22\x4d\x18'))  # lz4
+
 # file header
 LF_STRUCT = struct.Struct(b"<4sHHHHHLLLHH")
 LF_TUPLE = namedtuple("fileheader",
@@ -26,9 +61,10 @@ LF_MAGIC = b'\x50\x4b\x03\x04'
 # extra fields
 EXTRA_STRUCT = struct.Struct(b"<HH")
 EXTRA_TUPLE = namedtuple("extra", ("signature", "size"))
-EXTRA_64_STRUCT = struct.Struct(b"<HH")
+EXTRA_64_ID = 0x0001
+EXTRA_64_STRUCT = struct.Struct(b"<QQ")
 EXTRA_64_TUPLE = namedtuple("extra64local", ("uncomp_size", "comp_size"))
-CD_EXTRA_64_STRUCT = struct.Struct(b"<HHH")
+CD_EXTRA_64_STRUCT = struct.Struct(b"<QQQ")
 CD_EXTRA_64_TUPLE = namedtuple(
     "extra64cdir", ("uncomp_size", "comp_size", "offset"))
 
@@ -40,9 +76,9 @@ DD_TUPLE = namedtuple("filecrc",
 DD_MAGIC = b'\x50\x4b\x07\x08'
 
 # central directory file header
-CDLF_STRUCT = struct.Struct(b"<4sBBHHHHHLLLHHHHHLL")
+CDLF_STRUCT = struct.Struct(b"<4sHHHHHHLLLHHHHHLL")
 CDLF_TUPLE = namedtuple("cdfileheader",
-                        ("signature", "system", "version", "version_ndd", "flags",
+                        ("signature", "version_made", "version_ndd", "flags",
                          "compression", "mod_time", "mod_date", "crc",
                          "comp_size", "uncomp_size", "fname_len", "extra_len",
                          "fcomm_len", "disk_start", "attrs_int", "attrs_ext", "offset"))
@@ -54,3 +90,17 @@ CD_END_TUPLE = namedtuple("cdend",
                           ("signature", "disk_num", "disk_cdstart", "disk_entries",
                            "total_entries", "cd_size", "cd_offset", "comment_len"))
 CD_END_MAGIC = b'\x50\x4b\x05\x06'
+
+# zip64 end of central directory record
+CD_END64_STRUCT = struct.Struct(b"<4sQHHLLQQQQ")
+CD_END64_TUPLE = namedtuple("cdend64",
+                            ("signature", "rec_size", "version", "version_ndd",
+                             "disk_num", "disk_cdstart", "disk_entries",
+                             "total_entries", "cd_size", "cd_offset"))
+CD_END64_MAGIC = b'\x50\x4b\x06\x06'
+
+# zip64 end of central directory locator
+CD_LOC64_STRUCT = struct.Struct(b"<4sLQL")
+CD_LOC64_TUPLE = namedtuple("cdloc64",
+                            ("signature", "disk_cdstart", "offset", "disks_total"))
+CD_LOC64_MAGIC = b'\x50\x4b\x06\x07'
@@ -0,0 +1,76 @@
+#
+# Instrumentation of archive streaming
+#
+import time
+
+
+__all__ = ("Observer", "EntryStats", "ArchiveStats")
+
+
+class EntryStats:
+    """
+    Statistics of single archive entry.
+    Times are in seconds, start and end are taken from time.perf_counter
+    """
+    __slots__ = ('name', 'compression', 'start', 'end', 'in_bytes',
+                 'out_bytes', 'read_time', 'compress_time', 'crc')
+
+    def __init__(self, name, compression):
+        self.name = name
+        self.compression = compression
+        self.start = self.end = None
+        self.in_bytes = self.out_bytes = 0
+        self.read_time = self.compress_time = 0.0
+        self.crc = None
+
+    @property
+    def ratio(self):
+        # compressed to original size
+        return self.out_bytes / self.in_bytes if self.in_bytes else 1.0
+
+
+class ArchiveStats:
+    """
+    Statistics of whole archive.
+    Times are in seconds, start and end are taken from time.perf_counter
+    """
+    __slots__ = ('start', 'end', 'ttfb', 'total_bytes', 'entries', 'cdir_size')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = self.ttfb = None
+        self.total_bytes = self.entries = self.cdir_size = 0
+
+
+class Observer:
+    """
+    Base class of observers, which are notified about progress of streaming.
+    All methods do nothing by default, so only required ones should be
+    overridden. Methods are called from streaming thread, except of
+    entries processed ahead by workers.
+    """
+
+    def archive_start(self, archive):
+        """
+        streaming of archive is started, archive is ArchiveStats
+        """
+
+    def first_byte(self, archive):
+        """
+        first chunk of archive is ready to be sent
+        """
+
+    def archive_end(self, archive):
+        """
+        whole archive is streamed
+        """
+
+    def entry_start(self, entry):
+        """
+        streaming of entry is started, entry is EntryStats
+        """
+
+    def entry_end(self, entry):
+        """
+        entry is streamed, all statistics of entry are known
+        """
@@ -0,0 +1,342 @@
+#
+# ZIP File stream reading
+# based on official ZIP File Format Specification version 6.3.4
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+#
+import struct
+import zlib
+from . import consts
+
+
+__all__ = ("UnzipStream", )
+
+
+# returned by parser states, when more data is required
+_NEED_DATA = object()
+
+
+class _ZlibDecoder:
+    """
+    Raw deflate decompressor, returning at most limit bytes at once
+    """
+
+    def __init__(self, limit):
+        self.dec = zlib.decompressobj(-15)
+        self.limit = limit
+        self.input = b''
+
+    def feed(self, data):
+        self.input = data
+
+    def step(self):
+        # None is returned when all input is processed
+        if not self.input:
+            return None
+        chunk = self.dec.decompress(self.input, self.limit)
+        self.input = self.dec.unconsumed_tail
+        return chunk
+
+    @property
+    def eof(self):
+        return self.dec.eof
+
+    @property
+    def unused_data(self):
+        return self.dec.unused_data
+
+
+class _Decoder(_ZlibDecoder):
+    """
+    Wrapper of bz2 and lzma decompressors, with the same interface
+    """
+
+    def __init__(self, dec, limit):
+        self.dec = dec
+        self.limit = limit
+        self.input = b''
+
+    def step(self):
+        if self.dec.needs_input:
+            if not self.input:
+                return None
+            data, self.input = self.input, b''
+        else:
+            data = b''
+        return self.dec.decompress(data, self.limit)
+
+
+def _bzip2_decoder(limit, header):
+    import bz2
+    return _Decoder(bz2.BZ2Decompressor(), limit)
+
+
+def _lzma_decoder(limit, header):
+    import lzma
+    flt = lzma._decode_filter_properties(lzma.FILTER_LZMA1, header[4:])
+    return _Decoder(lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[flt]), limit)
+
+
+def _lzma_header_size(buf):
+    # header of lzma data, see section 5.8.8 of ZIP File Format Specification
+    if len(buf) < 4:
+        return None
+    return 4 + struct.unpack_from(b"<H", buf, 2)[0]
+
+
+# decoders of compression methods, by id of method
+DECODERS = {consts.COMPRESSION_DEFLATE: lambda limit, header: _ZlibDecoder(limit),
+            consts.COMPRESSION_BZIP2: _bzip2_decoder,
+            consts.COMPRESSION_LZMA: _lzma_decoder}
+
+
+class _UnzipParser:
+    """
+    Parser of zip archive, which is fed with data and returns events:
+    ('entry', name), ('data', chunk) and ('entry_end', None).
+    It does no I/O, so it is shared by synchronous and asynchronous reader.
+    Central directory is not read, parsing stops at its beginning.
+    """
+
+    def __init__(self, chunksize):
+        self.chunksize = chunksize
+        self.buf = bytearray()
+        self.state = self._header
+        self.done = False
+
+    def feed(self, data):
+        if not self.done:
+            self.buf += data
+
+    def finish(self):
+        """
+        called at the end of data
+        """
+        if not self.done:
+            raise Exception("Unexpected end of archive")
+
+    def next_event(self):
+        """
+        next event, or None if more data is required
+        """
+        while not self.done:
+            event = self.state()
+            if event is _NEED_DATA:
+                return None
+            if event is not None:
+                return event
+        return None
+
+    def _take(self, size):
+        chunk = bytes(self.buf[:size])
+        del self.buf[:size]
+        return chunk
+
+    def _header(self):
+        if len(self.buf) < 4:
+            return _NEED_DATA
+        signature = bytes(self.buf[:4])
+        if signature in (consts.CDFH_MAGIC, consts.CD_END_MAGIC, consts.CD_END64_MAGIC):
+            # all entries are read
+            self.done = True
+            self.buf = bytearray()
+            return None
+        if signature != consts.LF_MAGIC:
+            raise Exception("Unexpected signature %r, local file header expected" % signature)
+        if len(self.buf) < consts.LF_STRUCT.size:
+            return _NEED_DATA
+        head = consts.LF_TUPLE(*consts.LF_STRUCT.unpack_from(self.buf))
+        size = consts.LF_STRUCT.size + head.fname_len + head.extra_len
+        if len(self.buf) < size:
+            return _NEED_DATA
+        self._take(consts.LF_STRUCT.size)
+        fname = self._take(head.fname_len)
+        extra = self._take(head.extra_len)
+        if head.flags & 0x01:
+            raise Exception("Encrypted entries are not supported")
+        if head.compression != consts.COMPRESSION_STORE \
+                and head.compression not in DECODERS:
+            raise Exception("Unknown compression method %d" % head.compression)
+        self.head = head
+        self.name = fname.decode("utf-8" if head.flags & consts.UTF8_FLAG else "cp437")
+        self.zip64 = False
+        self.comp_size = head.comp_size
+        pos = 0
+        while pos + consts.EXTRA_STRUCT.size <= len(extra):
+            signature, length = consts.EXTRA_STRUCT.unpack_from(extra, pos)
+            pos += consts.EXTRA_STRUCT.size
+            if signature == consts.EXTRA_64_ID:
+                self.zip64 = True
+                # only sizes not fitting into header are present
+                values = extra[pos:pos + length]
+                if head.uncomp_size == 0xffffffff and len(values) >= 8:
+                    values = values[8:]
+                if head.comp_size == 0xffffffff and len(values) >= 8:
+                    self.comp_size = struct.unpack_from(b"<Q", values)[0]
+            pos += length
+        # size of data is known only without data descriptor
+        self.known_size = not head.flags & 0x08
+        self.crc = self.size = self.csize = 0
+        self.decoder = None
+        self.state = self._data
+        return ('entry', self.name)
+
+    def _chunk(self, chunk):
+        # data of entry
+        self.crc = zlib.crc32(chunk, self.crc)
+        self.size += len(chunk)
+        return ('data', chunk)
+
+    def _data(self):
+        if self.head.compression == consts.COMPRESSION_STORE:
+            if self.known_size:
+                return self._stored_data()
+            return self._scanned_data()
+        if self.decoder is None:
+            header = b''
+            if self.head.compression == consts.COMPRESSION_LZMA:
+                size = _lzma_header_size(self.buf)
+                if size is None or len(self.buf) < size:
+                    return _NEED_DATA
+                header = self._take(size)
+                self.csize += size
+            self.decoder = DECODERS[self.head.compression](self.chunksize, header)
+        while not self.decoder.eof:
+            chunk = self.decoder.step()
+            if chunk is None:
+                if not self.buf:
+                    return _NEED_DATA
+                self.csize += len(self.buf)
+                self.decoder.feed(self._take(len(self.buf)))
+            elif chunk:
+                return self._chunk(chunk)
+        # data after compressed stream goes back to buffer
+        unused = self.decoder.unused_data
+        self.csize -= len(unused)
+        self.buf[0:0] = unused
+        return self._data_end()
+
+    def _stored_data(self):
+        # not compressed data of known size
+        size = min(self.comp_size - self.size, self.chunksize)
+        if not size:
+            self.csize = self.size
+            return self._data_end()
+        if not self.buf:
+            return _NEED_DATA
+        return self._chunk(self._take(size))
+
+    def _scanned_data(self):
+        """
+        Not compressed data of unknown size, it ends with data descriptor.
+        Descriptor is recognized by its signature, crc and sizes.
+        """
+        pos = self.buf.find(consts.DD_MAGIC)
+        if pos < 0:
+            # signature can be split between chunks
+            pos = len(self.buf) - len(consts.DD_MAGIC) + 1
+            if pos <= 0:
+                return _NEED_DATA
+        if pos > 0:
+            return self._chunk(self._take(min(pos, self.chunksize)))
+        dd_struct = self._dd_struct(self.size, self.size)
+        size = len(consts.DD_MAGIC) + dd_struct.size
+        if len(self.buf) < size:
+            return _NEED_DATA
+        crc, comp_size, uncomp_size = dd_struct.unpack_from(self.buf, len(consts.DD_MAGIC))
+        if crc == self.crc & 0xffffffff and comp_size == uncomp_size == self.size:
+            self.csize = self.size
+            del self.buf[:size]
+            return self._entry_end()
+        # signature is part of data
+        pos = self.buf.find(consts.DD_MAGIC, 1)
+        if pos < 0:
+            pos = len(self.buf)
+        return self._chunk(self._take(min(pos, self.chunksize)))
+
+    def _dd_struct(self, size, csize):
+        if self.zip64 or max(size, csize) > consts.ZIP32_LIMIT:
+            return consts.DD_STRUCT64
+        return consts.DD_STRUCT
+
+    def _data_end(self):
+        if self.known_size:
+            self._check(self.head.crc, self.comp_size, self.size
+                        if self.head.uncomp_size == 0xffffffff else self.head.uncomp_size)
+            return self._entry_end()
+        self.state = self._descriptor
+        return None
+
+    def _descriptor(self):
+        if len(self.buf) < len(consts.DD_MAGIC):
+            return _NEED_DATA
+        # signature of descriptor is optional
+        pos = len(consts.DD_MAGIC) if self.buf[:4] == consts.DD_MAGIC else 0
+        dd_struct = self._dd_struct(self.size, self.csize)
+        if len(self.buf) < pos + dd_struct.size:
+            return _NEED_DATA
+        descriptor = consts.DD_TUPLE(*dd_struct.unpack_from(self.buf, pos))
+        del self.buf[:pos + dd_struct.size]
+        self._check(descriptor.crc, descriptor.comp_size, descriptor.uncomp_size)
+        return self._entry_end()
+
+    def _check(self, crc, comp_size, uncomp_size):
+        if crc != self.crc & 0xffffffff:
+            raise Exception("Bad CRC-32 of %r" % self.name)
+        if (comp_size, uncomp_size) != (self.csize, self.size):
+            raise Exception("Bad size of %r" % self.name)
+
+    def _entry_end(self):
+        self.state = self._header
+        return ('entry_end', None)
+
+
+class UnzipStream:
+    """
+    Reader of zip archive streamed as chunks of bytes. Archive is read
+    forward only, in bounded memory, so it does not have to be stored
+    first. Entries must have sizes in local headers, or data descriptors
+    (as archives created by ZipStream have).
+    """
+
+    def __init__(self, chunks, chunksize=64 * 1024):
+        """
+        chunks - iterable returning chunks of archive
+        chunksize - max size of chunks of entry data
+        """
+        self.chunks = chunks
+        self.chunksize = chunksize
+
+    def _events(self):
+        parser = _UnzipParser(self.chunksize)
+        src = iter(self.chunks)
+        while True:
+            event = parser.next_event()
+            if event is not None:
+                yield event
+            elif parser.done:
+                return
+            else:
+                chunk = next(src, None)
+                if chunk is None:
+                    parser.finish()
+                parser.feed(chunk)
+
+    def _entry_data(self, events):
+        for kind, value in events:
+            if kind != 'data':
+                return
+            yield value
+
+    def stream(self):
+        """
+        Stream entries of archive, as tuples of name and iterator of
+        its data. Data must be read before next entry, otherwise it
+        is skipped. Crc and sizes of data are checked when it is read.
+        """
+        events = self._events()
+        for kind, value in events:
+            data = self._entry_data(events)
+            yield value, data
+            # skip not read data
+            for chunk in data:
+                pass
@@ -0,0 +1,60 @@
+#
+# Sources of files from directory tree
+#
+import fnmatch
+import os
+
+
+__all__ = ("walk_files", )
+
+
+def _matches(path, name, patterns):
+    # patterns are matched against relative path and name of file
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(path, pattern) or fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def walk_files(path, prefix='', include=None, exclude=None, directories=True,
+               **params):
+    """
+    Generator of sources of all files in directory tree, which can be
+    passed to ZipStream. Tree is walked with os.scandir, and stat results
+    of its entries are passed to archive, so each file is checked once.
+    path - directory which is walked
+    prefix - path of files in archive, eg. 'backup/'
+    include - (optional) glob patterns, only files matching any of them
+              are added
+    exclude - (optional) glob patterns, files and directories matching
+              any of them are skipped
+    directories - add entries of directories to archive
+    Rest of parameters (eg. compression) is added to each file source.
+    Patterns are matched against name of file, and its path relative to
+    walked directory, with '/' separators. Symbolic links to files are
+    followed, links to directories are skipped.
+    """
+    return _walk(path, prefix, '', include, exclude, directories, params)
+
+
+def _walk(top, prefix, rel, include, exclude, directories, params):
+    with os.scandir(top) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        name = rel + entry.name
+        if exclude and _matches(name, entry.name, exclude):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            if directories:
+                yield {'directory': entry.path, 'name': prefix + name + '/',
+                       'stat': entry.stat(follow_symlinks=False)}
+            for source in _walk(entry.path, prefix, name + '/', include,
+                                exclude, directories, params):
+                yield source
+        elif entry.is_file():
+            if include and not _matches(name, entry.name, include):
+                continue
+            source = dict(params)
+            source.update({'file': entry.path, 'name': prefix + name,
+                           'stat': entry.stat()})
+            yield source
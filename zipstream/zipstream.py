@@ -4,46 +4,171 @@
 # https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
 #
 import os
+import functools
+import itertools
+import mmap
+import struct
 import time
 import zlib
+import hashlib
+import queue
+import tempfile
+import threading
+from collections import deque, namedtuple
 from . import consts
+from .cache import DEDUP_SPOOL_SIZE, _DedupStore
+from .observer import EntryStats, ArchiveStats
 
 
-__all__ = ("ZipStream", )
+__all__ = ("ZipStream", "split_files")
+
+
+def _directory_name(source):
+    # name of directory entry in archive, always ending with slash
+    name = source.get('name') or \
+        os.path.basename(os.path.normpath(source['directory']))
+    return name if name.endswith('/') else name + '/'
+
+
+def _stored_by_name(name):
+    # file is already compressed, judging by extension
+    return os.path.splitext(name)[1].lower() in consts.STORED_EXTENSIONS
+
+
+def _compressible(sample):
+    """
+    Guess if data is worth of compression,
+    basing on sample from its beginning
+    """
+    if not sample:
+        return False
+    for offset, magic in consts.STORED_MAGIC:
+        if sample[offset:offset + len(magic)] == magic:
+            return False
+    # fast compression of sample must save at least 10%
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+
+def _peek(src, size):
+    """
+    Read at least size bytes from beginning of stream.
+    Returns read data and stream which yields all data again
+    """
+    src = iter(src)
+    chunks = []
+    length = 0
+    for chunk in src:
+        chunks.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return b''.join(chunks)[:size], itertools.chain(chunks, src)
+
+
+class _LZMACompressor:
+    """
+    LZMA compressor, which adds header required by zip format,
+    see section 5.8.8 of ZIP File Format Specification
+    """
+
+    def __init__(self, level):
+        import lzma
+        props = lzma._encode_filter_properties(
+            {'id': lzma.FILTER_LZMA1, 'preset': level})
+        self.header = struct.pack(b"<BBH", 9, 4, len(props)) + props
+        self.compr = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+            lzma._decode_filter_properties(lzma.FILTER_LZMA1, props)])
+
+    def compress(self, chunk):
+        chunk = self.header + self.compr.compress(chunk)
+        self.header = b''
+        return chunk
+
+    def flush(self):
+        chunk = self.header + self.compr.flush()
+        self.header = b''
+        return chunk
+
+
+def _deflate_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+def _bzip2_compressor(level):
+    import bz2
+    return bz2.BZ2Compressor(level)
+
+
+# compression method:
+# cmpr_id - id of method in zip format
+# version - version of zip format required to extract
+# flags - general purpose flags set for method
+# factory - function creating compressor for given level, None for store
+# levels - allowed compression levels
+# default_level - level used if not set
+Codec = namedtuple("Codec", ("cmpr_id", "version", "flags", "factory",
+                             "levels", "default_level"))
+
+# registry of compression methods, by name used in 'compression' entry
+CODECS = {}
+
+
+def register_codec(name, cmpr_id, version, factory, levels=(), default_level=None,
+                   flags=0):
+    """
+    Add compression method, which can be used by 'compression' entry.
+    Factory is called with compression level, and should return object
+    with compress(data) and flush() methods, like zlib compressor.
+    """
+    CODECS[name] = Codec(cmpr_id, version, flags, factory,
+                         tuple(levels), default_level)
+
+
+register_codec(None, consts.COMPRESSION_STORE, consts.ZIP32_VERSION, None)
+register_codec('deflate', consts.COMPRESSION_DEFLATE, consts.ZIP32_VERSION,
+               _deflate_compressor, range(10), 5)
+register_codec('bzip2', consts.COMPRESSION_BZIP2, consts.BZIP2_VERSION,
+               _bzip2_compressor, range(1, 10), 9)
+register_codec('lzma', consts.COMPRESSION_LZMA, consts.LZMA_VERSION,
+               _LZMACompressor, range(10), 6, consts.LZMA_EOS_FLAG)
 
 
 class Processor:
     def __init__(self, file_struct):
         self.crc = 0
         self.o_size = self.c_size = 0
-        if file_struct['cmethod'] is None:
+        if file_struct.cmethod is None:
             self.process = self._process_through
             self.tail = self._no_tail
-        elif file_struct['cmethod'] == 'deflate':
-            self.compr = zlib.compressobj(5, zlib.DEFLATED, -15)
-            self.process = self._process_deflate
-            self.tail = self._tail_deflate
+        else:
+            codec = CODECS[file_struct.cmethod]
+            self.compr = codec.factory(file_struct.clevel)
+            self.process = self._process_compress
+            self.tail = self._tail_compress
 
     # no compression
     def _process_through(self, chunk):
         self.o_size += len(chunk)
         self.c_size = self.o_size
         self.crc = zlib.crc32(chunk, self.crc)
+        if isinstance(chunk, memoryview):
+            # view of reused buffer, streamed data must stay valid
+            chunk = bytes(chunk)
         return chunk
 
     def _no_tail(self):
         return b''
 
-    # deflate compression
-    def _process_deflate(self, chunk):
+    # compression
+    def _process_compress(self, chunk):
         self.o_size += len(chunk)
         self.crc = zlib.crc32(chunk, self.crc)
         chunk = self.compr.compress(chunk)
         self.c_size += len(chunk)
         return chunk
 
-    def _tail_deflate(self):
-        chunk = self.compr.flush(zlib.Z_FINISH)
+    def _tail_compress(self):
+        chunk = self.compr.flush()
         self.c_size += len(chunk)
         return chunk
 
@@ -52,9 +177,229 @@ class Processor:
         return self.crc, self.o_size, self.c_size
 
 
+def _gf2_times(mat, vec):
+    # multiply 32x32 matrix over GF(2) by vector
+    result = idx = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[idx]
+        vec >>= 1
+        idx += 1
+    return result
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_shift_matrix(length):
+    """
+    Matrix which applied to crc32 value (see crc32_combine) gives crc32
+    of the same data followed by `length` zero bytes.
+    Port of crc32_combine() from zlib, which is not exposed by python.
+    """
+    # operator for one zero bit
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    # operators for two and four zero bits
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    ops = []
+    while length:
+        even = _gf2_square(odd)
+        if length & 1:
+            ops.append(even)
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_square(even)
+        if length & 1:
+            ops.append(odd)
+        length >>= 1
+    # compose all operators into single one
+    mat = [1 << n for n in range(32)]
+    for op in ops:
+        mat = [_gf2_times(op, col) for col in mat]
+    return mat
+
+
+def crc32_combine(crc1, crc2, length2, matrix=None):
+    """
+    Calculate crc32 of concatenated data blocks, using crc32 of both
+    blocks and length of second one. Precalculated crc32_shift_matrix
+    for given length can be passed, to make it fast.
+    """
+    if matrix is None:
+        matrix = crc32_shift_matrix(length2)
+    return _gf2_times(matrix, crc1 & 0xffffffff) ^ (crc2 & 0xffffffff)
+
+
+def _deflate_block(block, level, zdict, last):
+    """
+    Compress independent block of data into raw deflate stream.
+    Last 32kB of previous block is used as dictionary, so stream can be
+    simply concatenated with output of previous block.
+    """
+    if zdict:
+        compr = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL,
+                                 zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    chunk = compr.compress(block)
+    # sync flush finishes block at byte boundary without ending the stream
+    chunk += compr.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return chunk, zlib.crc32(block) & 0xffffffff, len(block)
+
+
+class _TimedProcessor:
+    """
+    Wrapper of processor, which measures time of processing
+    """
+
+    def __init__(self, pcs, stats):
+        self.pcs = pcs
+        self.stats = stats
+
+    def process(self, chunk):
+        start = time.perf_counter()
+        chunk = self.pcs.process(chunk)
+        self.stats.compress_time += time.perf_counter() - start
+        return chunk
+
+    def tail(self):
+        start = time.perf_counter()
+        chunk = self.pcs.tail()
+        self.stats.compress_time += time.perf_counter() - start
+        return chunk
+
+    def state(self):
+        return self.pcs.state()
+
+
+def _timed_data(data, stats):
+    """
+    Pass data through, measuring time of reading it
+    """
+    data = iter(data)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(data)
+        except StopIteration:
+            stats.read_time += time.perf_counter() - start
+            return
+        stats.read_time += time.perf_counter() - start
+        yield chunk
+
+
+class BlockProcessor(Processor):
+    """
+    Deflate processor, which splits data of entry into blocks compressed
+    concurrently by executor (similar to pigz). Compressed blocks are
+    joined into single deflate stream, and crc32 of blocks is combined.
+    """
+
+    def __init__(self, file_struct, executor, block_size, workers):
+        self.crc = 0
+        self.o_size = self.c_size = 0
+        self.executor = executor
+        self.level = file_struct.clevel
+        self.block_size = block_size
+        self.max_pending = workers * 2
+        self.buf = bytearray()
+        self.zdict = b''
+        self.pending = deque()
+        self.matrices = {}
+        self.process = self._process_blocks
+        self.tail = self._tail_blocks
+
+    def _submit(self, block, last):
+        self.pending.append(self.executor.submit(
+            _deflate_block, block, self.level, self.zdict, last))
+        self.zdict = block[-32768:]
+
+    def _collect(self, wait_all=False):
+        # return compressed blocks in order, waits only when
+        # there are too many blocks in progress
+        out = []
+        while self.pending:
+            if not (wait_all or self.pending[0].done()
+                    or len(self.pending) > self.max_pending):
+                break
+            chunk, crc, length = self.pending.popleft().result()
+            if length not in self.matrices:
+                self.matrices[length] = crc32_shift_matrix(length)
+            self.crc = crc32_combine(self.crc, crc, length,
+                                     self.matrices[length])
+            self.o_size += length
+            self.c_size += len(chunk)
+            out.append(chunk)
+        return b''.join(out)
+
+    def _process_blocks(self, chunk):
+        self.buf += chunk
+        while len(self.buf) >= self.block_size:
+            block = bytes(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+            self._submit(block, False)
+        return self._collect()
+
+    def _tail_blocks(self):
+        self._submit(bytes(self.buf), True)
+        self.buf = bytearray()
+        return self._collect(wait_all=True)
+
+
+# size of memory mapped file is checked once per this much data
+MMAP_CHECK_SIZE = 1024 * 1024
+
+# zip64 extra field of local header, real sizes are in data descriptor
+_EXTRA_64_LOCAL = consts.EXTRA_STRUCT.pack(
+    consts.EXTRA_64_ID, consts.EXTRA_64_STRUCT.size) + consts.EXTRA_64_STRUCT.pack(0, 0)
+
+
+class _FileStruct:
+    """
+    Properties of single archive entry, required to build its headers.
+    Archives can have millions of entries, so slots are used.
+    """
+    __slots__ = ('crc', 'offset', 'flags', 'zip64', 'src', 'stype', 'fsize',
+                 'fkey', 'mod_time', 'mod_date', 'cmethod', 'clevel',
+                 'cmpr_id', 'version', 'fname', 'size', 'csize', 'stats',
+                 'dkey', 'attrs')
+
+    def __init__(self, zip64):
+        self.crc = 0  # will be calculated during data streaming
+        self.offset = 0  # file header offset in zip file
+        self.flags = 0b00001000  # flag about using data descriptor is always on
+        self.zip64 = zip64
+        self.src = self.stype = self.fkey = self.stats = self.dkey = None
+        self.fsize = self.size = self.csize = None
+        # external attributes, unix mode is stored in high 16 bits
+        self.attrs = 0
+
+
+@functools.lru_cache(maxsize=4096)
+def _dos_datetime(second):
+    """
+    time and date in DOS format, for timestamp in whole seconds
+    """
+    dt = time.localtime(second)
+    if dt[0] < 1980:
+        # DOS date can't be older
+        dt = (1980, 1, 1, 0, 0, 0)
+    dosdate = ((dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]) \
+        & 0xffff
+    dostime = (dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)) \
+        & 0xffff
+    return dostime, dosdate
+
+
 class ZipBase:
 
-    def __init__(self, files=[], chunksize=1024):
+    def __init__(self, files=[], chunksize=1024, block_workers=0,
+                 block_size=128 * 1024, crc_cache=None,
+                 write_size=None, flush_interval=None, cache=None,
+                 compression_level=None, observer=None, budget=None):
         """
         files - list of files, or generator returning files
                 each file entry should be represented as dict with
@@ -67,72 +412,242 @@ class ZipBase:
                          chunks of data that will be streamed in archive.
                          If used, then 'name' entry is required.
         chunksize - default size of data block streamed from files
+        block_workers - number of threads compressing blocks of single
+                        deflate entry concurrently. 0 turns it off.
+        block_size - size of block compressed independently
+        crc_cache - (optional) dict like object, where crc32 of not compressed
+                    files is stored after streaming. Used by stream_range,
+                    to avoid reading whole files just for crc.
+        write_size - (optional) small chunks of archive are gathered into
+                     chunks of this size before streaming
+        flush_interval - (optional) max time in seconds, after which
+                         gathered data is streamed, even if smaller
+                         than write_size
+        cache - (optional) EntryCache, where compressed files are stored
+                and reused in next archives
+        compression_level - (optional) default compression level of entries,
+                            if not set, default level of method is used.
+                            It is limited to levels allowed by method,
+                            and not used for not compressed entries.
+        observer - (optional) Observer notified about progress of streaming
+        budget - (optional) Budget of buffers, compressors and workers,
+                 shared with other streams. Stream waits for its buffers
+                 and worker threads before it starts, and for compressor
+                 before each compressed entry.
         """
         self._source_of_files = files
-        self.__files = []
+        # central directory is kept packed, entries are not needed
+        # after they are streamed
+        self.__cdir = bytearray()
+        self.__entries = 0
         self.__version = consts.ZIP32_VERSION
         self.zip64 = False
         self.chunksize = chunksize
         # this flag tuns on signature for data descriptor record.
         # see section 4.3.9.3 of ZIP File Format Specification
         self.__use_ddmagic = True
-        # central directory size and placement
-        self.__cdir_size = self.__offset = 0
+        # placement of streamed data
+        self.__offset = 0
+        self.block_workers = block_workers
+        self.block_size = block_size
+        self.__block_executor = None
+        self.crc_cache = crc_cache
+        self.write_size = write_size
+        self.flush_interval = flush_interval
+        self.cache = cache
+        self.compression_level = compression_level
+        self.observer = observer
+        self._archive_stats = None
+        self.budget = budget
 
     def zip64_required(self):
         """
         Turn on zip64 mode for archive
+        all entries created from now on will use zip64 extra fields
+        and archive will be finished with zip64 end of central directory
         """
-        raise NotImplementedError("Zip64 is not supported yet")
+        self.zip64 = True
+
+    def _block_processed(self, file_struct):
+        """
+        data of file is compressed in blocks by BlockProcessor
+        """
+        return bool(self.block_workers) and file_struct.cmethod == 'deflate'
+
+    def _make_processor(self, file_struct):
+        """
+        Create processor of data for given file. Executor of blocks
+        must be started by _start_block_executor before.
+        """
+        if self._block_processed(file_struct):
+            pcs = BlockProcessor(file_struct, self.__block_executor,
+                                 self.block_size, self.block_workers)
+        else:
+            pcs = Processor(file_struct)
+        if file_struct.stats is not None:
+            pcs = _TimedProcessor(pcs, file_struct.stats)
+        return pcs
+
+    def _request(self, resource, amount=1):
+        """
+        request resource of budget, returns ticket,
+        or None if there is no budget
+        """
+        if self.budget is None:
+            return None
+        return self.budget.request(resource, amount)
+
+    def _compressor_request(self, file_struct):
+        """
+        request compressor of budget for compressed entry
+        """
+        if file_struct.cmethod is None:
+            return None
+        return self._request('compressors')
+
+    def _buffers_size(self):
+        """
+        size of buffers used by stream, reserved in budget
+        """
+        size = self.chunksize + (self.write_size or 0)
+        if self.block_workers:
+            # blocks in progress, and block being filled
+            size += self.block_size * (self.block_workers * 2 + 1)
+        return size
+
+    def _threads(self):
+        """
+        number of worker threads used by stream, reserved in budget
+        """
+        return self.block_workers
+
+    def _admission_requests(self):
+        """
+        resources reserved in budget before stream starts. Threads are
+        started in pools of reserved size, so stream which needs more
+        of them than budget allows is rejected.
+        """
+        threads = self._threads()
+        limit = self.budget.limits['workers']
+        if limit is not None and threads > limit:
+            raise Exception("Stream uses %d worker threads, budget allows only %d"
+                            % (threads, limit))
+        requests = [('buffers', self._buffers_size())]
+        if threads:
+            requests.append(('workers', threads))
+        return requests
+
+    def _default_level(self, codec):
+        """
+        compression level of entry without its own level
+        """
+        if self.compression_level is None or not codec.levels:
+            return codec.default_level
+        return min(max(self.compression_level, min(codec.levels)),
+                   max(codec.levels))
+
+    def _dos_datetime(self, timestamp=None):
+        """
+        time and date of file in DOS format, current time is used
+        if timestamp is not set
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        # conversion is cached, files often share the same second
+        return _dos_datetime(int(timestamp))
+
+    def _auto_compression(self, file_struct, name):
+        """
+        Choose compression method for 'auto' compression, basing on
+        extension of file and sample of data from its beginning.
+        Beginning of stream is read, and stream is replaced.
+        """
+        if _stored_by_name(name):
+            return None
+        if file_struct.stype == 'f':
+            with open(file_struct.src, "rb") as fh:
+                sample = fh.read(consts.AUTO_SAMPLE_SIZE)
+        else:
+            sample, file_struct.src = _peek(file_struct.src,
+                                            consts.AUTO_SAMPLE_SIZE)
+        return 'deflate' if _compressible(sample) else None
 
     def _create_file_struct(self, data):
         """
         extract info about streamed file and return all processed data
         required in zip archive
         """
-        # date and time of file
-        dt = time.localtime()
-        dosdate = ((dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]) \
-            & 0xffff
-        dostime = (dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)) \
-            & 0xffff
-
-        # check zip32 limit
-        # stats = os.stat(data['file'])
-        #  if stats.st_size > consts.ZIP32_LIMIT:
-        #     self.zip64_required()
-        # file properties used in zip
-        file_struct = {'mod_time': dostime,
-                       'mod_date': dosdate,
-                       'crc': 0,  # will be calculated during data streaming
-                       "offset": 0,  # file header offset in zip file
-                       'flags': 0b00001000}  # flag about using data descriptor is always on
+        # file properties used in zip, zip64 extra field in local header
+        # is used when required, size of streams is unknown so it can be
+        # forced with 'zip64' entry
+        file_struct = _FileStruct(self.zip64 or bool(data.get('zip64', False)))
 
         if 'file' in data:
-            file_struct['src'] = data['file']
-            file_struct['stype'] = 'f'
+            file_struct.src = data['file']
+            file_struct.stype = 'f'
+            # check zip32 limit, compressed data can be
+            # little larger than source in worst case,
+            # stat result can be passed to avoid another system call
+            stats = data.get('stat') or os.stat(data['file'])
+            file_struct.fsize = stats.st_size
+            if stats.st_size * 1.05 > consts.ZIP32_LIMIT:
+                file_struct.zip64 = True
+            # identity of file content, used to cache crc
+            file_struct.fkey = (data['file'], stats.st_size,
+                                stats.st_mtime_ns, stats.st_ino)
+            mtime = stats.st_mtime
+            file_struct.attrs = (stats.st_mode & 0xffff) << 16
+        elif 'directory' in data:
+            # entry of directory, without any data
+            file_struct.src = data['directory']
+            file_struct.stype = 'd'
+            file_struct.fsize = 0
+            stats = data.get('stat') or os.stat(data['directory'])
+            mtime = stats.st_mtime
+            file_struct.attrs = (stats.st_mode & 0xffff) << 16 | consts.MSDOS_DIR_ATTR
+            data['compression'] = None
+            data['name'] = _directory_name(data)
         elif 'stream' in data:
-            file_struct['src'] = data['stream']
-            file_struct['stype'] = 's'
+            file_struct.src = data['stream']
+            file_struct.stype = 's'
+            mtime = None
         else:
             raise Exception('No file or stream in sources')
 
-        cmpr = data.get('compression', None)
-        if cmpr not in (None, 'deflate'):
-            raise Exception('Unknown compression method %r' % cmpr)
-        file_struct['cmethod'] = cmpr
-        file_struct['cmpr_id'] = {
-            None: consts.COMPRESSION_STORE,
-            'deflate': consts.COMPRESSION_DEFLATE}[cmpr]
+        # date and time of file, current time is used for streams
+        file_struct.mod_time, file_struct.mod_date = \
+            self._dos_datetime(mtime)
 
         # file name in archive
         if 'name' not in data:
             data['name'] = os.path.basename(data['file'])
+
+        cmpr = data.get('compression', None)
+        if cmpr == 'auto':
+            cmpr = self._auto_compression(file_struct, data['name'])
+        if cmpr not in CODECS:
+            raise Exception('Unknown compression method %r' % cmpr)
+        codec = CODECS[cmpr]
+        level = data.get('compression_level')
+        if level is None or not codec.levels:
+            # level is not used by store, also when chosen by 'auto'
+            level = self._default_level(codec)
+        elif level not in codec.levels:
+            raise Exception('Wrong compression level %r of %r method' % (level, cmpr))
+        file_struct.cmethod = cmpr
+        file_struct.clevel = level
+        file_struct.cmpr_id = codec.cmpr_id
+        file_struct.flags |= codec.flags
+        file_struct.version = max(codec.version, consts.ZIP64_VERSION
+                                  if file_struct.zip64 else self.__version)
+
         try:
-            file_struct['fname'] = data['name'].encode("ascii")
+            file_struct.fname = data['name'].encode("ascii")
         except UnicodeError:
-            file_struct['fname'] = data['name'].encode("utf-8")
-            file_struct['flags'] |= consts.UTF8_FLAG
+            file_struct.fname = data['name'].encode("utf-8")
+            file_struct.flags |= consts.UTF8_FLAG
+        if self.observer is not None:
+            file_struct.stats = EntryStats(data['name'], cmpr)
         return file_struct
 
     # zip structures creation
@@ -141,31 +656,24 @@ class ZipBase:
         """
         Extra field for file
         """
-        fields = {"signature": signature,
-                  "size": len(data)}
-        head = consts.EXTRA_TUPLE(**fields)
-        head = consts.EXTRA_STRUCT.pack(*head)
-        return head + data
+        return consts.EXTRA_STRUCT.pack(signature, len(data)) + data
 
     def _make_local_file_header(self, file_struct):
         """
         Create file header
         """
-        fields = {"signature": consts.LF_MAGIC,
-                  "version": self.__version,
-                  "flags": file_struct['flags'],
-                  "compression": file_struct['cmpr_id'],
-                  "mod_time": file_struct['mod_time'],
-                  "mod_date": file_struct['mod_date'],
-                  "crc": 0,
-                  "uncomp_size": 0,
-                  "comp_size": 0,
-                  "fname_len": len(file_struct['fname']),
-                  "extra_len": 0}
-        head = consts.LF_TUPLE(**fields)
-        head = consts.LF_STRUCT.pack(*head)
-        head += file_struct['fname']
-        return head
+        extra = b''
+        size = 0
+        if file_struct.zip64:
+            # real sizes are stored in data descriptor
+            extra = _EXTRA_64_LOCAL
+            size = 0xffffffff
+        # fields are packed in order of consts.LF_TUPLE
+        return consts.LF_STRUCT.pack(
+            consts.LF_MAGIC, file_struct.version, file_struct.flags,
+            file_struct.cmpr_id, file_struct.mod_time, file_struct.mod_date,
+            0, size, size, len(file_struct.fname), len(extra)
+        ) + file_struct.fname + extra
 
     def _make_data_descriptor(self, file_struct, crc, org_size, compr_size):
         """
@@ -173,14 +681,17 @@ class ZipBase:
         This function also updates size and crc fields of file_struct
         """
         # hack for making CRC unsigned long
-        file_struct['crc'] = crc & 0xffffffff
-        file_struct['size'] = org_size
-        file_struct['csize'] = compr_size
-        fields = {"uncomp_size": file_struct['size'],
-                  "comp_size": file_struct['csize'],
-                  "crc": file_struct['crc']}
-        descriptor = consts.DD_TUPLE(**fields)
-        descriptor = consts.DD_STRUCT.pack(*descriptor)
+        file_struct.crc = crc & 0xffffffff
+        file_struct.size = org_size
+        file_struct.csize = compr_size
+        if max(org_size, compr_size) > consts.ZIP32_LIMIT:
+            # size of streamed data crossed zip32 limit,
+            # switch entry to zip64 after the fact
+            file_struct.zip64 = True
+            file_struct.version = max(file_struct.version,
+                                      consts.ZIP64_VERSION)
+        dd_struct = consts.DD_STRUCT64 if file_struct.zip64 else consts.DD_STRUCT
+        descriptor = dd_struct.pack(file_struct.crc, compr_size, org_size)
         if self.__use_ddmagic:
             descriptor = consts.DD_MAGIC + descriptor
         return descriptor
@@ -189,56 +700,330 @@ class ZipBase:
         """
         Create central directory file header
         """
-        fields = {"signature": consts.CDFH_MAGIC,
-                  "system": 0x03,  # 0x03 - unix
-                  "version": self.__version,
-                  "version_ndd": self.__version,
-                  "flags": file_struct['flags'],
-                  "compression": file_struct['cmpr_id'],
-                  "mod_time": file_struct['mod_time'],
-                  "mod_date": file_struct['mod_date'],
-                  "uncomp_size": file_struct['size'],
-                  "comp_size": file_struct['csize'],
-                  "offset": file_struct['offset'],  # < file header offset
-                  "crc": file_struct['crc'],
-                  "fname_len": len(file_struct['fname']),
-                  "extra_len": 0,
-                  "fcomm_len": 0,  # comment length
-                  "disk_start": 0,
-                  "attrs_int": 0,
-                  "attrs_ext": 0}
-        cdfh = consts.CDLF_TUPLE(**fields)
-        cdfh = consts.CDLF_STRUCT.pack(*cdfh)
-        cdfh += file_struct['fname']
-        return cdfh
-
-    def _make_cdend(self):
+        extra = b''
+        sizes = (file_struct.size, file_struct.csize, file_struct.offset)
+        if file_struct.zip64 or max(sizes) > consts.ZIP32_LIMIT:
+            # all values are moved to zip64 extra field
+            extra = self._make_extra_field(consts.EXTRA_64_ID,
+                                           consts.CD_EXTRA_64_STRUCT.pack(*sizes))
+            sizes = (0xffffffff, ) * 3
+            file_struct.version = max(file_struct.version,
+                                      consts.ZIP64_VERSION)
+        # fields are packed in order of consts.CDLF_TUPLE, system in high
+        # byte of version made by is unix (0x03), so attributes are unix
+        # mode, comment length, disk start and internal attributes are 0
+        return consts.CDLF_STRUCT.pack(
+            consts.CDFH_MAGIC, consts.UNIX_SYSTEM << 8 | file_struct.version,
+            file_struct.version,
+            file_struct.flags, file_struct.cmpr_id, file_struct.mod_time,
+            file_struct.mod_date, file_struct.crc, sizes[1], sizes[0],
+            len(file_struct.fname), len(extra), 0, 0, 0, file_struct.attrs, sizes[2]
+        ) + file_struct.fname + extra
+
+    def _make_cdend(self, entries, cd_size, cd_offset):
         """
         make end of central directory record
         """
-        fields = {"signature": consts.CD_END_MAGIC,
-                  "disk_num": 0,
-                  "disk_cdstart": 0,
-                  "disk_entries": len(self.__files),
-                  "total_entries": len(self.__files),
-                  "cd_size": self.__cdir_size,
-                  "cd_offset": self._offset_get(),
-                  "comment_len": 0}
-        cdend = consts.CD_END_TUPLE(**fields)
-        cdend = consts.CD_END_STRUCT.pack(*cdend)
-        return cdend
+        if self.zip64 \
+                or entries >= consts.ZIP32_ENTRIES_LIMIT \
+                or max(cd_size, cd_offset) > consts.ZIP32_LIMIT:
+            # zip64 records goes before regular end of central directory
+            # and regular one is filled with placeholders
+            cdend = self._make_cdend64(entries, cd_size, cd_offset)
+            entries = min(entries, consts.ZIP32_ENTRIES_LIMIT)
+            cd_size = min(cd_size, 0xffffffff)
+            cd_offset = min(cd_offset, 0xffffffff)
+        else:
+            cdend = b''
+        # fields are packed in order of consts.CD_END_TUPLE
+        return cdend + consts.CD_END_STRUCT.pack(
+            consts.CD_END_MAGIC, 0, 0, entries, entries, cd_size, cd_offset, 0)
+
+    def _make_cdend64(self, entries, cd_size, cd_offset):
+        """
+        make zip64 end of central directory record and its locator
+        """
+        # size of remaining record is without leading 12 bytes
+        cdend64 = consts.CD_END64_STRUCT.pack(
+            consts.CD_END64_MAGIC, consts.CD_END64_STRUCT.size - 12,
+            consts.ZIP64_VERSION, consts.ZIP64_VERSION, 0, 0,
+            entries, entries, cd_size, cd_offset)
+        # zip64 end record is placed just after central directory
+        cdloc64 = consts.CD_LOC64_STRUCT.pack(
+            consts.CD_LOC64_MAGIC, 0, cd_offset + cd_size, 1)
+        return cdend64 + cdloc64
 
     def _make_end_structures(self):
         """
         cdir and cdend structures are saved at the end of zip file
         """
         # stream central directory entries
-        for idx, file_struct in enumerate(self.__files):
+        cdir = memoryview(self.__cdir)
+        step = max(self.chunksize, 64 * 1024)
+        for pos in range(0, len(cdir), step):
+            yield bytes(cdir[pos:pos + step])
+        cdir.release()
+        if self._archive_stats is not None:
+            self._archive_stats.entries = self.__entries
+            self._archive_stats.cdir_size = len(self.__cdir)
+        # stream end of central directory
+        yield self._make_cdend(self.__entries, len(self.__cdir),
+                               self._offset_get())
+
+    def _plan(self):
+        """
+        Calculate layout of archive, without reading any data.
+        Possible only for not compressed files, which size is known.
+        Returns list of file structs with offsets and
+        sizes filled in, and size of whole archive.
+        """
+        entries = []
+        offset = 0
+        for source in self._source_of_files:
+            if 'stream' in source:
+                # checked before file struct is created, as it would
+                # read sample of stream for 'auto' compression
+                raise Exception(
+                    "Size of %r entry is unknown before streaming, only "
+                    "not compressed files are supported" % source.get('name'))
+            file_struct = self._create_file_struct(source)
+            if file_struct.stype not in ('f', 'd') \
+                    or file_struct.cmethod is not None:
+                raise Exception(
+                    "Size of %r entry is unknown before streaming, only "
+                    "not compressed files are supported" % file_struct.fname)
+            size = file_struct.fsize
+            file_struct.offset = offset
+            offset += len(self._make_local_file_header(file_struct)) + size
+            # crc is not known yet, but it does not change descriptor size
+            offset += len(self._make_data_descriptor(file_struct, 0, size, size))
+            entries.append(file_struct)
+        cd_size = 0
+        for file_struct in entries:
+            cd_size += len(self._make_cdir_file_header(file_struct))
+        offset += cd_size
+        offset += len(self._make_cdend(len(entries), cd_size, offset - cd_size))
+        return entries, offset
+
+    def total_size(self):
+        """
+        Size of archive in bytes, calculated before streaming.
+        List of files (not generator) is required, and all entries must be
+        not compressed files. Files should not change until streamed.
+        """
+        return self._plan()[1]
+
+    def _file_crc(self, file_struct):
+        """
+        crc32 of not compressed file, taken from cache if possible
+        """
+        if file_struct.stype == 'd':
+            return 0
+        key = file_struct.fkey
+        if self.crc_cache is not None and key in self.crc_cache:
+            return self.crc_cache[key]
+        crc = size = 0
+        # buffer is reused, to avoid allocation of each chunk
+        buf = bytearray(max(self.chunksize, 65536))
+        view = memoryview(buf)
+        with open(file_struct.src, "rb") as fh:
+            while True:
+                length = fh.readinto(buf)
+                if not length:
+                    break
+                crc = zlib.crc32(view[:length], crc)
+                size += length
+        if size != file_struct.fsize:
+            raise Exception("File %r changed during streaming" % file_struct.src)
+        crc &= 0xffffffff
+        if self.crc_cache is not None:
+            self.crc_cache[key] = crc
+        return crc
+
+    def _file_started(self, file_struct):
+        """
+        called before first byte of file is streamed
+        """
+        stats = file_struct.stats
+        stats.start = time.perf_counter()
+        self.observer.entry_start(stats)
+
+    def _file_streamed(self, file_struct):
+        """
+        called when all data of file is streamed
+        """
+        if self.crc_cache is not None and file_struct.stype == 'f' \
+                and file_struct.cmethod is None \
+                and file_struct.size == file_struct.fsize:
+            self.crc_cache[file_struct.fkey] = file_struct.crc
+        if self.observer is not None:
+            stats = file_struct.stats
+            stats.end = time.perf_counter()
+            stats.in_bytes = file_struct.size
+            stats.out_bytes = file_struct.csize
+            stats.crc = file_struct.crc
+            self.observer.entry_end(stats)
+
+    def _observed(self, parts):
+        """
+        pass streamed archive through, notifying observer
+        """
+        stats = self._archive_stats = ArchiveStats()
+        self.observer.archive_start(stats)
+        for part in parts:
+            if stats.ttfb is None:
+                stats.ttfb = time.perf_counter() - stats.start
+                self.observer.first_byte(stats)
+            stats.total_bytes += len(part)
+            yield part
+        stats.end = time.perf_counter()
+        self._archive_stats = None
+        self.observer.archive_end(stats)
+
+    def _range_parts(self, start, end):
+        """
+        Parts of archive between start and end offset, without reading
+        files before start. Each part is bytes, or FilePart for data of file.
+        """
+        def cut(data):
+            # part of data overlapping with requested range
+            return data[max(start - pos, 0):max(end - pos, 0)]
+
+        entries, total = self._plan()
+        if end is None or end > total:
+            end = total
+        pos = 0
+        for file_struct in entries:
+            if pos >= end:
+                return
+            size = file_struct.fsize
+            head = self._make_local_file_header(file_struct)
+            chunk = cut(head)
+            if chunk:
+                yield chunk
+            pos += len(head)
+            # directories and empty files have no data
+            if size and pos < end and pos + size > start:
+                offset = max(start - pos, 0)
+                yield FilePart(file_struct.src, offset, min(end - pos, size) - offset)
+            pos += size
+            # descriptor size is always the same, crc is calculated
+            # only when descriptor is in range
+            if pos < end and pos + self._dd_size(file_struct) > start:
+                crc = self._file_crc(file_struct)
+            else:
+                crc = 0
+            chunk = self._make_data_descriptor(file_struct, crc, size, size)
+            if cut(chunk):
+                yield cut(chunk)
+            pos += len(chunk)
+        cd_offset = pos
+        for file_struct in entries:
+            if pos >= end:
+                return
             chunk = self._make_cdir_file_header(file_struct)
-            self.__cdir_size += len(chunk)
+            if pos + len(chunk) > start:
+                file_struct.crc = self._file_crc(file_struct)
+                yield cut(self._make_cdir_file_header(file_struct))
+            pos += len(chunk)
+        chunk = cut(self._make_cdend(len(entries), pos - cd_offset, cd_offset))
+        if chunk:
             yield chunk
-        # stream end of central directory
-        yield self._make_cdend()
+
+    def _dd_size(self, file_struct):
+        size = consts.DD_STRUCT64.size if file_struct.zip64 \
+            else consts.DD_STRUCT.size
+        if self.__use_ddmagic:
+            size += len(consts.DD_MAGIC)
+        return size
+
+    def _cached_entry(self, file_struct):
+        """
+        find compressed file in cache
+        """
+        if self.cache is None or file_struct.stype != 'f' \
+                or file_struct.cmethod is None:
+            return None
+        return self.cache.get(file_struct)
+
+    def _cache_writer(self, file_struct):
+        """
+        create writer of compressed file into cache
+        """
+        if self.cache is None or file_struct.stype != 'f' \
+                or file_struct.cmethod is None:
+            return None
+        return self.cache.writer(file_struct)
+
+    def _cache_commit(self, file_struct, writer, state):
+        crc, org_size, compr_size = state
+        if file_struct.stype != 'f' or org_size == file_struct.fsize:
+            writer.commit(crc, org_size, compr_size)
+        else:
+            # file changed during streaming
+            writer.abort()
+
+    def _load_cdir(self, fh):
+        """
+        Read central directory of existing archive from file object,
+        so new entries are streamed after entries of that archive,
+        in place of its central directory. Returns offset of
+        central directory, where streamed data should be written.
+        """
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        # end record is followed only by comment, up to 64kB long
+        tail_size = min(size, consts.CD_END_STRUCT.size + 0xffff)
+        fh.seek(size - tail_size)
+        tail = fh.read(tail_size)
+        pos = tail.rfind(consts.CD_END_MAGIC)
+        if pos < 0 or pos + consts.CD_END_STRUCT.size > len(tail):
+            raise Exception("End of central directory not found")
+        cdend = consts.CD_END_TUPLE(*consts.CD_END_STRUCT.unpack_from(tail, pos))
+        entries, cd_size, cd_offset = \
+            cdend.total_entries, cdend.cd_size, cdend.cd_offset
+        if cdend.disk_num or cdend.disk_entries != cdend.total_entries:
+            raise Exception("Archives split into parts can't be appended")
+        end_offset = size - tail_size + pos
+        loc_offset = end_offset - consts.CD_LOC64_STRUCT.size
+        if loc_offset >= 0:
+            fh.seek(loc_offset)
+            data = fh.read(consts.CD_LOC64_STRUCT.size)
+            if data[:4] == consts.CD_LOC64_MAGIC:
+                loc64 = consts.CD_LOC64_TUPLE(*consts.CD_LOC64_STRUCT.unpack(data))
+                fh.seek(loc64.offset)
+                data = fh.read(consts.CD_END64_STRUCT.size)
+                cdend64 = consts.CD_END64_TUPLE(*consts.CD_END64_STRUCT.unpack(data))
+                if cdend64.signature != consts.CD_END64_MAGIC:
+                    raise Exception("Zip64 end of central directory not found")
+                entries, cd_size, cd_offset = \
+                    cdend64.total_entries, cdend64.cd_size, cdend64.cd_offset
+                end_offset = loc64.offset
+        if cd_offset + cd_size != end_offset:
+            raise Exception("Central directory is not placed before its end record")
+        fh.seek(cd_offset)
+        cdir = fh.read(cd_size)
+        # check all records, they are kept as they are
+        pos = count = 0
+        while pos < len(cdir):
+            if cdir[pos:pos + 4] != consts.CDFH_MAGIC:
+                raise Exception("Broken central directory at offset %d" % (cd_offset + pos))
+            head = consts.CDLF_TUPLE(*consts.CDLF_STRUCT.unpack_from(cdir, pos))
+            pos += consts.CDLF_STRUCT.size + head.fname_len + head.extra_len + head.fcomm_len
+            count += 1
+        if pos != len(cdir) or count != entries:
+            raise Exception("Broken central directory, %d entries found instead of %d"
+                            % (count, entries))
+        self.__cdir = bytearray(cdir)
+        self.__entries = entries
+        self.__offset = cd_offset
+        return cd_offset
+
+    def _is_plain_file(self, file_struct):
+        """
+        file, which is streamed without any processing
+        """
+        return file_struct.stype == 'f' and file_struct.cmethod is None
 
     def _offset_add(self, value):
         self.__offset += value
@@ -247,18 +1032,307 @@ class ZipBase:
         return self.__offset
 
     def _add_file_to_cdir(self, file_struct):
-        self.__files.append(file_struct)
+        # called when file is streamed, its header is complete then
+        self.__cdir += self._make_cdir_file_header(file_struct)
+        self.__entries += 1
 
     def _cleanup(self):
         """
         Clean all structs after streaming
         """
-        self.__files = []
-        self.__cdir_size = self.__offset = 0
+        self.__cdir = bytearray()
+        self.__entries = self.__offset = 0
+        self._shutdown_block_executor()
+
+    def _start_block_executor(self):
+        """
+        Create threads compressing blocks, before entries are processed.
+        It is done by streaming thread, as processors are created by
+        many workers at once.
+        """
+        if self.block_workers and self.__block_executor is None:
+            from concurrent import futures
+            self.__block_executor = futures.ThreadPoolExecutor(
+                max_workers=self.block_workers)
+
+    def _shutdown_block_executor(self):
+        """
+        Stop threads compressing blocks, also when streaming is interrupted
+        """
+        if self.__block_executor is not None:
+            self.__block_executor.shutdown(wait=True)
+            self.__block_executor = None
+
+
+def _write_all(fd, data):
+    # os.write can write only part of data
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class _Coalescer:
+    """
+    Gathers small chunks of data into buffer of fixed size, which is
+    flushed when full, or when given time passed since last flush
+    """
+
+    def __init__(self, size, interval=None):
+        self.size = size
+        self.interval = interval
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        self.last = time.monotonic()
+
+    def add(self, chunk):
+        """
+        add chunk to buffer, returns list of chunks ready to write
+        """
+        out = []
+        if not self.pos and len(chunk) >= self.size:
+            # large chunks are not copied
+            out.append(chunk)
+        else:
+            chunk = memoryview(chunk)
+            while len(chunk):
+                n = min(len(chunk), self.size - self.pos)
+                self.view[self.pos:self.pos + n] = chunk[:n]
+                self.pos += n
+                chunk = chunk[n:]
+                if self.pos == self.size:
+                    out.append(self.flush())
+        if self.interval is not None and self.pos \
+                and time.monotonic() - self.last >= self.interval:
+            out.append(self.flush())
+        if out:
+            self.last = time.monotonic()
+        return out
+
+    def flush(self):
+        chunk = bytes(self.view[:self.pos])
+        self.pos = 0
+        return chunk
+
+
+def _coalesce(chunks, size, interval=None):
+    """
+    stream chunks gathered into larger ones
+    """
+    buf = _Coalescer(size, interval)
+    for chunk in chunks:
+        for out in buf.add(chunk):
+            yield out
+    if buf.pos:
+        yield buf.flush()
+
+
+class FilePart:
+    """
+    Part of file which is streamed without reading it into memory,
+    eg. with os.sendfile. File can be already opened (fh), so it is
+    read even if it was removed in meantime.
+    """
+    __slots__ = ('path', 'offset', 'size', 'fh')
+
+    def __init__(self, path, offset, size, fh=None):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.fh = fh
+
+    def open(self):
+        """
+        open file of part, or duplicate of already opened file
+        """
+        if self.fh is None:
+            return open(self.path, "rb")
+        return os.fdopen(os.dup(self.fh.fileno()), "rb")
+
+    def __len__(self):
+        return self.size
+
+
+class _EntryBuffer:
+    """
+    Bounded buffer of processed chunks of single archive entry.
+    Filled by worker thread, drained when entry is streamed.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.chunks = deque()
+        self.state = None
+        self.error = None
+        self.done = self.cancelled = False
+        self.cond = threading.Condition()
+
+    def put(self, chunk):
+        """
+        add chunk to buffer, blocks when buffer is full.
+        Returns False if streaming was cancelled
+        """
+        with self.cond:
+            while self.size and self.size + len(chunk) > self.limit \
+                    and not self.cancelled:
+                self.cond.wait()
+            if self.cancelled:
+                return False
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+            return True
+
+    def finish(self, state=None, error=None):
+        with self.cond:
+            self.state = state
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self.cond:
+                while not self.chunks and not self.done:
+                    self.cond.wait()
+                if self.chunks:
+                    chunk = self.chunks.popleft()
+                    self.size -= len(chunk)
+                    self.cond.notify_all()
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield chunk
+
+
+def _fadvise(fd, length):
+    # hint kernel that file will be read sequentially, from its beginning
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def _spooled_data(spool, chunksize):
+    # data of spooled stream, file is closed when read
+    with spool:
+        while True:
+            chunk = spool.read(chunksize)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _ReadAhead:
+    """
+    Background thread reading files, one after another, into
+    pool of preallocated buffers. Files are read in order they are added,
+    so reading of next file starts while current one is still processed.
+    """
+
+    def __init__(self, chunksize, depth):
+        self.chunksize = chunksize
+        self.depth = depth
+        self.pool = queue.Queue()
+        for n in range(depth):
+            self.pool.put(bytearray(chunksize))
+        self.files = queue.Queue()
+        # filled chunks as (buffer, length), end of file has 0 length
+        self.chunks = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            path = self.files.get()
+            if path is None:
+                return
+            try:
+                with open(path, "rb") as fh:
+                    _fadvise(fh.fileno(), self.depth * self.chunksize)
+                    while True:
+                        buf = self.pool.get()
+                        if buf is None or self.closed:
+                            return
+                        length = fh.readinto(buf)
+                        self.chunks.put((buf, length))
+                        if not length:
+                            break
+            except Exception as e:
+                self.chunks.put((e, 0))
+
+    def add(self, path):
+        """
+        add file to read
+        """
+        self.files.put(path)
+
+    def read(self):
+        """
+        chunks of next added file, as memoryviews,
+        each is valid only until next one is requested
+        """
+        while True:
+            buf, length = self.chunks.get()
+            if isinstance(buf, Exception):
+                raise buf
+            try:
+                if not length:
+                    return
+                yield memoryview(buf)[:length]
+            finally:
+                self.pool.put(buf)
+
+    def close(self):
+        self.closed = True
+        self.files.put(None)
+        self.pool.put(None)
+        self.thread.join()
 
 
 class ZipStream(ZipBase):
 
+    def __init__(self, files=[], chunksize=1024, workers=0,
+                 buffer_limit=16 * 1024 * 1024, read_ahead=0,
+                 mmap_threshold=None, dedup=None, **kwargs):
+        """
+        workers - number of entries processed in parallel, using thread pool.
+                  Entries are compressed ahead in separate threads, but
+                  archive is still streamed in order. 0 turns it off.
+        buffer_limit - max size of data processed ahead, but not yet
+                       streamed, shared between all workers
+        read_ahead - number of chunks read ahead from files by background
+                     thread, while data is processed and streamed.
+                     Reading continues into next file. 0 turns it off,
+                     it is not used with workers.
+        mmap_threshold - (optional) files of at least this size are memory
+                         mapped, and their data is processed without copying.
+                         Files must not be truncated during streaming.
+        dedup - (optional) entries with the same content are read and
+                compressed once, their compressed data is reused by next
+                entries. Data is kept in temporary file, up to this size
+                in bytes. Files are identified by path, size, modification
+                time and inode, streams by hash of data.
+        """
+        super(ZipStream, self).__init__(files, chunksize, **kwargs)
+        self.workers = workers
+        self.buffer_limit = buffer_limit
+        self.read_ahead = read_ahead
+        self.mmap_threshold = mmap_threshold
+        self.dedup = dedup
+        self.__dedup = None
+
     def data_generator(self, src, src_type):
         if src_type == 's':
             for chunk in src:
@@ -266,6 +1340,9 @@ class ZipStream(ZipBase):
             return
         if src_type == 'f':
             with open(src, "rb") as fh:
+                if self.mmap_threshold is not None:
+                    for part in self._mapped_data(fh):
+                        yield part
                 while True:
                     part = fh.read(self.chunksize)
                     if not part:
@@ -273,36 +1350,550 @@ class ZipStream(ZipBase):
                     yield part
             return
 
-    def _stream_single_file(self, file_struct):
+    def _mapped_data(self, fh):
         """
-        stream single zip file with header and descriptor at the end
+        Data of large file as memoryviews of its memory map.
+        Size of file is checked once per MMAP_CHECK_SIZE of data, and
+        reading stops when file becomes smaller, as access beyond end
+        of file would crash. It is not safe for files truncated during
+        streaming, file can still be truncated after the check.
+        Position of file is moved after mapped data, so rest of it
+        can be read as usual.
         """
+        fd = fh.fileno()
+        size = os.fstat(fd).st_size
+        if size < max(self.mmap_threshold, 1):
+            return
+        try:
+            mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        pos = checked = 0
+        try:
+            view = memoryview(mm)
+            while pos < size:
+                end = min(pos + self.chunksize, size)
+                if end > checked:
+                    checked = min(pos + max(MMAP_CHECK_SIZE, self.chunksize), size)
+                    if os.fstat(fd).st_size < checked:
+                        # file was truncated
+                        break
+                yield view[pos:end]
+                pos = end
+        finally:
+            fh.seek(pos)
+            view = None
+            try:
+                mm.close()
+            except BufferError:
+                # last chunk is still referenced by consumer,
+                # map is released together with it
+                pass
+
+    def _read_file_part(self, part):
+        """
+        read data of FilePart
+        """
+        size = part.size
+        with part.open() as fh:
+            fh.seek(part.offset)
+            while size > 0:
+                chunk = fh.read(min(size, self.chunksize))
+                if not chunk:
+                    raise Exception("File %r changed during streaming" % part.path)
+                size -= len(chunk)
+                yield chunk
+
+    def _sendfile(self, fd, part):
+        """
+        send FilePart into file descriptor, using os.sendfile if available
+        """
+        if not hasattr(os, 'sendfile'):
+            for chunk in self._read_file_part(part):
+                _write_all(fd, chunk)
+            return
+        offset, size = part.offset, part.size
+        with part.open() as fh:
+            while size > 0:
+                sent = os.sendfile(fd, fh.fileno(), offset, size)
+                if not sent:
+                    raise Exception("File %r changed during streaming" % part.path)
+                offset += sent
+                size -= sent
+
+    def _sock_sendfile(self, sock, part):
+        """
+        send FilePart into socket
+        """
+        with part.open() as fh:
+            sent = sock.sendfile(fh, part.offset, part.size)
+        if sent != part.size:
+            raise Exception("File %r changed during streaming" % part.path)
+
+    def _stream_file_part(self, file_struct):
+        """
+        stream not compressed file with data as single FilePart
+        """
+        size = file_struct.fsize
         yield self._make_local_file_header(file_struct)
-        pcs = Processor(file_struct)
-        for chunk in self.data_generator(file_struct['src'], file_struct['stype']):
-            chunk = pcs.process(chunk)
+        yield FilePart(file_struct.src, 0, size)
+        crc = self._file_crc(file_struct)
+        yield self._make_data_descriptor(file_struct, crc, size, size)
+
+    def _stream_cached_file(self, file_struct, entry, file_parts=False):
+        """
+        stream single zip file, which compressed data is found in cache
+        """
+        try:
+            yield self._make_local_file_header(file_struct)
+            part = FilePart(entry.path, entry.offset, entry.csize, entry.fh)
+            if file_parts:
+                yield part
+            else:
+                for chunk in self._read_file_part(part):
+                    yield chunk
+        finally:
+            if entry.fh is not None:
+                entry.fh.close()
+        yield self._make_data_descriptor(file_struct, entry.crc,
+                                         entry.size, entry.csize)
+
+    def _processed_data(self, file_struct, pcs, data=None):
+        """
+        data of file processed by given processor,
+        it is also stored in cache if required
+        """
+        writers = [writer for writer in (self._cache_writer(file_struct),
+                                         self._dedup_writer(file_struct))
+                   if writer is not None]
+        if data is None:
+            data = self.data_generator(file_struct.src, file_struct.stype)
+        if file_struct.stats is not None:
+            data = _timed_data(data, file_struct.stats)
+        try:
+            for chunk in data:
+                chunk = pcs.process(chunk)
+                if len(chunk) > 0:
+                    for writer in writers:
+                        writer.write(chunk)
+                    yield chunk
+            chunk = pcs.tail()
             if len(chunk) > 0:
+                for writer in writers:
+                    writer.write(chunk)
                 yield chunk
-        chunk = pcs.tail()
-        if len(chunk) > 0:
-            yield chunk
+            for writer in writers:
+                self._cache_commit(file_struct, writer, pcs.state())
+        finally:
+            for writer in writers:
+                writer.abort()
+
+    def _stream_single_file(self, file_struct, data=None):
+        """
+        stream single zip file with header and descriptor at the end
+        """
+        yield self._make_local_file_header(file_struct)
+        ticket = self._compressor_request(file_struct)
+        if ticket is not None:
+            ticket.wait()
+        try:
+            pcs = self._make_processor(file_struct)
+            for chunk in self._processed_data(file_struct, pcs, data):
+                yield chunk
+        finally:
+            if ticket is not None:
+                ticket.release()
         yield self._make_data_descriptor(file_struct, *pcs.state())
 
+    def _process_ahead(self, file_struct, buf, ticket=None):
+        """
+        process data of single file into buffer, runs in worker thread
+        """
+        try:
+            if ticket is not None:
+                ticket.wait()
+                if buf.cancelled:
+                    return
+            pcs = self._make_processor(file_struct)
+            for chunk in self._processed_data(file_struct, pcs):
+                if not buf.put(chunk):
+                    return
+            buf.finish(state=pcs.state())
+        except Exception as e:
+            buf.finish(error=e)
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    def _stream_processed_file(self, file_struct, buf):
+        """
+        stream single zip file, which data is processed by worker
+        """
+        yield self._make_local_file_header(file_struct)
+        for chunk in buf:
+            yield chunk
+        yield self._make_data_descriptor(file_struct, *buf.state)
+
+    def _ready_file(self, file_struct, file_parts=False):
+        """
+        Generator of entry data, which does not require processing:
+        not compressed file streamed as FilePart, or entry found in cache.
+        Returns None if data must be processed.
+        """
+        if file_parts and self._is_plain_file(file_struct):
+            return self._stream_file_part(file_struct)
+        if self.dedup is not None and file_struct.stype != 'd':
+            if self.__dedup is None:
+                self.__dedup = _DedupStore(self.dedup)
+            file_struct.dkey = self._dedup_key(file_struct)
+            entry = None
+            if file_struct.dkey is not None:
+                entry = self.__dedup.get(file_struct.dkey)
+            if entry is not None:
+                return self._stream_cached_file(file_struct, entry, file_parts)
+        entry = self._cached_entry(file_struct)
+        if entry is not None:
+            return self._stream_cached_file(file_struct, entry, file_parts)
+        return None
+
+    def _dedup_key(self, file_struct):
+        """
+        Identity of entry content: files are identified by path, size,
+        modification time and inode, streams by hash of their data.
+        Stream is read here, and replaced by its copy. Streams larger
+        than dedup limit are not deduplicated, None is returned for them.
+        """
+        if file_struct.stype == 'f':
+            key = file_struct.fkey
+        else:
+            digest = hashlib.sha256()
+            spool = tempfile.SpooledTemporaryFile(max_size=DEDUP_SPOOL_SIZE)
+            src = iter(file_struct.src)
+            size = 0
+            for chunk in src:
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+                if size > self.dedup:
+                    # too large to be kept, rest of data is streamed directly
+                    spool.seek(0)
+                    file_struct.src = itertools.chain(
+                        _spooled_data(spool, self.chunksize), src)
+                    return None
+            spool.seek(0)
+            file_struct.src = _spooled_data(spool, self.chunksize)
+            key = digest.digest()
+        return (key, file_struct.cmpr_id, file_struct.clevel)
+
+    def _dedup_writer(self, file_struct):
+        """
+        create writer of compressed data, reused by entries with the same content
+        """
+        if file_struct.dkey is None:
+            return None
+        return self.__dedup.writer(file_struct.dkey)
+
+    def _buffers_size(self):
+        size = super(ZipStream, self)._buffers_size()
+        if self.workers:
+            size += self.buffer_limit
+        return size + self.read_ahead * self.chunksize
+
+    def _threads(self):
+        threads = super(ZipStream, self)._threads() + self.workers
+        if self.read_ahead and not self.workers:
+            # thread of _ReadAhead
+            threads += 1
+        return threads
+
+    def _cleanup(self):
+        super(ZipStream, self)._cleanup()
+        if self.__dedup is not None:
+            self.__dedup.close()
+            self.__dedup = None
+
+    def _entries(self, file_parts=False):
+        """
+        file structs of archive entries, with generators of their data.
+        If file_parts is set, data of not compressed and
+        cached files is streamed as FilePart.
+        """
+        if self.read_ahead:
+            return self._read_ahead_entries(file_parts)
+        return self._sequential_entries(file_parts)
+
+    def _sequential_entries(self, file_parts=False, reader=None):
+        for source in self._source_of_files:
+            file_struct = self._create_file_struct(source)
+            chunks = self._ready_file(file_struct, file_parts)
+            if chunks is None:
+                data = None
+                if reader is not None and file_struct.stype == 'f':
+                    reader.add(file_struct.src)
+                    data = reader.read()
+                chunks = self._stream_single_file(file_struct, data)
+            yield file_struct, chunks
+
+    def _read_ahead_entries(self, file_parts=False):
+        """
+        same as _entries, but files are read by background thread.
+        Next entry is created before current one is streamed,
+        so its file is read as soon as current one is read.
+        """
+        reader = _ReadAhead(self.chunksize, self.read_ahead)
+        ahead = deque()
+        try:
+            for entry in self._sequential_entries(file_parts, reader):
+                ahead.append(entry)
+                if len(ahead) > 1:
+                    yield ahead.popleft()
+            while ahead:
+                yield ahead.popleft()
+        finally:
+            reader.close()
+
+    def _parallel_entries(self, file_parts=False):
+        """
+        same as _entries, but data of next entries is processed ahead
+        """
+        from concurrent import futures
+        limit = max(self.buffer_limit // self.workers, 1)
+        sources = iter(self._source_of_files)
+        pending = deque()
+        pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                # keep all workers busy
+                while len(pending) < self.workers:
+                    try:
+                        source = next(sources)
+                    except StopIteration:
+                        break
+                    file_struct = self._create_file_struct(source)
+                    buf = ticket = None
+                    chunks = self._ready_file(file_struct, file_parts)
+                    if chunks is None:
+                        buf = _EntryBuffer(limit)
+                        # compressors are requested in order of entries,
+                        # so entry being streamed gets one first
+                        ticket = self._compressor_request(file_struct)
+                        pool.submit(self._process_ahead, file_struct, buf, ticket)
+                        chunks = self._stream_processed_file(file_struct, buf)
+                    pending.append((file_struct, chunks, buf, ticket))
+                if not pending:
+                    break
+                file_struct, chunks, buf, ticket = pending[0]
+                yield file_struct, chunks
+                pending.popleft()
+        finally:
+            # stop workers if streaming was interrupted
+            for file_struct, chunks, buf, ticket in pending:
+                if buf is not None:
+                    buf.cancel()
+                if ticket is not None:
+                    ticket.release()
+            pool.shutdown(wait=True)
+
     def stream(self):
         """
         Stream complete archive
         """
-        # stream files
-        for idx, source in enumerate(self._source_of_files):
-            file_struct = self._create_file_struct(source)
-            # file offset in archive
-            file_struct['offset'] = self._offset_get()
-            self._add_file_to_cdir(file_struct)
-            # file data
-            for chunk in self._stream_single_file(file_struct):
-                self._offset_add(len(chunk))
+        parts = self._archive_parts()
+        if self.write_size:
+            parts = _coalesce(parts, self.write_size, self.flush_interval)
+        if self.observer is not None:
+            parts = self._observed(parts)
+        return parts
+
+    def _archive_parts(self, file_parts=False):
+        """
+        Stream complete archive, as bytes and FileParts if requested
+        """
+        tickets = self._admission()
+        self._start_block_executor()
+        entries = None
+        try:
+            if self.workers:
+                entries = self._parallel_entries(file_parts)
+            else:
+                entries = self._entries(file_parts)
+            # stream files
+            for file_struct, chunks in entries:
+                # file offset in archive
+                file_struct.offset = self._offset_get()
+                if self.observer is not None:
+                    self._file_started(file_struct)
+                # file data
+                for chunk in chunks:
+                    self._offset_add(len(chunk))
+                    yield chunk
+                self._file_streamed(file_struct)
+                self._add_file_to_cdir(file_struct)
+            # stream zip structures
+            for chunk in self._make_end_structures():
                 yield chunk
-        # stream zip structures
-        for chunk in self._make_end_structures():
-            yield chunk
-        self._cleanup()
+            self._cleanup()
+        finally:
+            # workers are stopped before executor of blocks
+            if entries is not None:
+                entries.close()
+            self._shutdown_block_executor()
+            for ticket in tickets:
+                ticket.release()
+
+    def _admission(self):
+        """
+        wait for buffers and workers of budget, before stream starts
+        """
+        if self.budget is None:
+            return []
+        return [self.budget.acquire(resource, amount)
+                for resource, amount in self._admission_requests()]
+
+    def append_to(self, path):
+        """
+        Append entries to existing archive file. Entries are written in place
+        of its central directory, followed by central directory of all
+        entries, so data of existing entries is not read nor copied.
+        Archive is restored if streaming fails.
+        Returns number of bytes written.
+        """
+        total = 0
+        with open(path, "r+b") as fh:
+            cd_offset = self._load_cdir(fh)
+            fh.seek(cd_offset)
+            # central directory and end records, which are overwritten
+            old_tail = fh.read()
+            fh.seek(cd_offset)
+            try:
+                for chunk in self.stream():
+                    fh.write(chunk)
+                    total += len(chunk)
+                fh.truncate()
+            except BaseException:
+                fh.seek(cd_offset)
+                fh.write(old_tail)
+                fh.truncate()
+                raise
+        return total
+
+    def stream_range(self, start, end=None):
+        """
+        Stream only part of archive, from start offset up to end
+        offset (excluding). Can be used to serve HTTP range requests.
+        The same restrictions as for total_size() apply here. Files before
+        requested range are not read at all, crc32 of files is taken from
+        crc_cache, or calculated if required.
+        """
+        for part in self._range_parts(start, end):
+            if isinstance(part, FilePart):
+                for chunk in self._read_file_part(part):
+                    yield chunk
+            else:
+                yield part
+
+    def stream_to(self, out):
+        """
+        Stream complete archive into socket, file descriptor or file object.
+        Data of not compressed files is sent with sendfile, without copying
+        it through python, rest of archive is streamed as usual.
+        Returns number of bytes written.
+        """
+        if hasattr(out, 'sendall'):
+            write = out.sendall
+
+            def sendfile(part):
+                self._sock_sendfile(out, part)
+        else:
+            if hasattr(out, 'flush'):
+                out.flush()
+            fd = out if isinstance(out, int) else out.fileno()
+
+            def write(chunk):
+                _write_all(fd, chunk)
+
+            def sendfile(part):
+                self._sendfile(fd, part)
+        total = 0
+        parts = self._archive_parts(file_parts=True)
+        if self.observer is not None:
+            parts = self._observed(parts)
+        for part in parts:
+            if isinstance(part, FilePart):
+                sendfile(part)
+            else:
+                write(part)
+            total += len(part)
+        return total
+
+
+def _compressed_bound(cmpr, size, ratio):
+    """
+    Max size of compressed data, or its estimate
+    """
+    if cmpr is None:
+        return size
+    if ratio is not None:
+        return int(size * ratio) + 1
+    if cmpr in ('deflate', 'auto'):
+        # deflateBound() of zlib, for raw deflate stream
+        return size + (size >> 12) + (size >> 14) + (size >> 25) + 7
+    # other methods have no documented bound
+    return size + size // 100 + 1024
+
+
+def _entry_size_bound(source, ratio):
+    """
+    Space taken by entry in archive, with its central directory record
+    """
+    if 'file' in source:
+        size = (source.get('stat') or os.stat(source['file'])).st_size
+        name = source.get('name') or os.path.basename(source['file'])
+    elif 'directory' in source:
+        size = 0
+        name = _directory_name(source)
+    elif 'size' in source:
+        size = source['size']
+        name = source['name']
+    else:
+        raise Exception("Size of stream %r is unknown, 'size' entry is required"
+                        % source.get('name'))
+    name = len(name.encode("utf-8"))
+    csize = _compressed_bound(source.get('compression'), size, ratio)
+    # zip64 extra fields and descriptor are counted, in case they are used
+    return consts.LF_STRUCT.size + name + len(_EXTRA_64_LOCAL) + csize \
+        + len(consts.DD_MAGIC) + consts.DD_STRUCT64.size \
+        + consts.CDLF_STRUCT.size + name \
+        + consts.EXTRA_STRUCT.size + consts.CD_EXTRA_64_STRUCT.size
+
+
+def split_files(files, max_size, compression_ratio=None):
+    """
+    Split list of files into parts, each of them can be streamed as
+    separate archive not larger than max_size. Order of files is kept.
+    Sizes of files are taken from file system, streams require 'size'
+    entry with size of their data. Size of compressed data is upper bound
+    for deflate, and estimate for other methods. If compression_ratio
+    (compressed size to original one) is set, it is used instead, then
+    parts are fuller, but can exceed max_size.
+    Parts are independent, so they can be streamed concurrently.
+    """
+    end_size = consts.CD_END_STRUCT.size + consts.CD_END64_STRUCT.size \
+        + consts.CD_LOC64_STRUCT.size
+    parts = []
+    part, size = [], end_size
+    for source in files:
+        entry_size = _entry_size_bound(source, compression_ratio)
+        if entry_size + end_size > max_size:
+            raise Exception("Entry %r does not fit into part of %d bytes"
+                            % (source.get('name') or source.get('file'), max_size))
+        if part and size + entry_size > max_size:
+            parts.append(part)
+            part, size = [], end_size
+        part.append(source)
+        size += entry_size
+    if part:
+        parts.append(part)
+    return parts